@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Mede o desempenho da pilha inteira (Servidor -> IP -> CamadaEnlace) sobre
+linhas seriais simuladas (vide camadafisica.LinhaVirtual), sem precisar das
+placas nem de PTYs:
+
+ * eco: vazão de um servidor de eco, em bytes por segundo;
+ * latencia: percentis do tempo de ida e volta de mensagens pequenas;
+ * conexoes: taxa de estabelecimento de conexões (handshakes por segundo);
+ * encaminhamento: datagramas por segundo encaminhados por um roteador.
+
+Os tempos são medidos no relógio de parede, então, com as opções padrão
+(linhas sem limite de taxa), o resultado reflete o custo de processamento da
+pilha. Os resultados são escritos em JSON. Com --comparar, são confrontados
+com um arquivo de resultados anterior, e o programa termina com erro se
+alguma medida piorar além da tolerância.
+
+Exemplo:
+    ./benchmark.py --saida base.json
+    ./benchmark.py --comparar base.json
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+from camadafisica import par_de_linhas
+from ip import IP
+from slip import CamadaEnlace, LIMIAR_DESCARGA
+from tcp import Servidor
+from metricas import registro
+
+PORTA_ECO = 7000
+PORTA_CLIENTE = 40000
+
+# Tempo sem receber datagramas após o qual o teste de encaminhamento termina,
+# além do tempo de transmissão nas linhas (vide tempo_de_espera)
+SILENCIO = 0.5
+
+# Bytes acrescentados a cada segmento no fio: cabeçalho IP e os END do SLIP
+SOBRECARGA_QUADRO = 20 + 2
+
+# Para cada medida comparável: True se valores maiores são melhores
+MEDIDAS = {
+    ('eco', 'bytes_por_segundo'): True,
+    ('latencia', 'p50'): False,
+    ('latencia', 'p99'): False,
+    ('conexoes', 'por_segundo'): True,
+    ('encaminhamento', 'datagramas_por_segundo'): True,
+}
+
+
+def montar_pilha(endereco, linhas_seriais, tabela):
+    rede = IP(CamadaEnlace(linhas_seriais))
+    rede.definir_endereco_host(endereco)
+    rede.definir_tabela_encaminhamento(tabela)
+    return rede
+
+
+def dois_hosts(opcoes_linha):
+    """
+    Cliente (10.0.0.1) e servidor de eco (10.0.0.2) ligados por uma linha.
+    Retorna o Servidor do lado cliente, usado para abrir as conexões, e o
+    servidor de eco.
+    """
+    a, b = par_de_linhas(**opcoes_linha)
+    rede_cliente = montar_pilha('10.0.0.1', {'10.0.0.2': a}, [('0.0.0.0/0', '10.0.0.2')])
+    rede_servidor = montar_pilha('10.0.0.2', {'10.0.0.1': b}, [('0.0.0.0/0', '10.0.0.1')])
+
+    def dados_recebidos(conexao, dados):
+        if dados == b'':
+            conexao.fechar()
+        else:
+            conexao.enviar(dados)
+
+    eco = Servidor(rede_servidor, PORTA_ECO)
+    eco.registrar_monitor_de_conexoes_aceitas(lambda c: c.registrar_recebedor(dados_recebidos))
+    return Servidor(rede_cliente, PORTA_CLIENTE), eco
+
+
+def desmontar(*servidores):
+    for servidor in servidores:
+        servidor.fechar()
+
+
+async def conectar(cliente, recebedor):
+    estabelecida = asyncio.get_event_loop().create_future()
+    conexao = cliente.conectar('10.0.0.2', PORTA_ECO, lambda c: estabelecida.set_result(c))
+    conexao.registrar_recebedor(recebedor)
+    await estabelecida
+    return conexao
+
+
+async def medir_eco(opcoes_linha, total):
+    cliente, eco = dois_hosts(opcoes_linha)
+    recebidos = 0
+    fim = asyncio.get_event_loop().create_future()
+
+    def recebedor(conexao, dados):
+        nonlocal recebidos
+        recebidos += len(dados)
+        if recebidos >= total and not fim.done():
+            fim.set_result(None)
+
+    conexao = await conectar(cliente, recebedor)
+    inicio = time.perf_counter()
+    conexao.enviar(bytes(total))
+    await fim
+    segundos = time.perf_counter() - inicio
+    conexao.fechar()
+    desmontar(cliente, eco)
+    return {'bytes': total, 'segundos': segundos, 'bytes_por_segundo': total / segundos}
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(p / 100 * len(valores)))]
+
+
+async def medir_latencia(opcoes_linha, mensagens, tamanho):
+    cliente, eco = dois_hosts(opcoes_linha)
+    resposta = None
+
+    def recebedor(conexao, dados):
+        nonlocal resposta
+        resposta.recebidos += len(dados)
+        if resposta.recebidos >= tamanho and not resposta.done():
+            resposta.set_result(None)
+
+    conexao = await conectar(cliente, recebedor)
+    loop = asyncio.get_event_loop()
+    amostras = []
+    for _ in range(mensagens):
+        resposta = loop.create_future()
+        resposta.recebidos = 0
+        inicio = time.perf_counter()
+        conexao.enviar(bytes(tamanho))
+        await resposta
+        amostras.append(time.perf_counter() - inicio)
+    conexao.fechar()
+    desmontar(cliente, eco)
+    return {
+        'mensagens': mensagens,
+        'tamanho': tamanho,
+        'p50': percentil(amostras, 50),
+        'p90': percentil(amostras, 90),
+        'p99': percentil(amostras, 99),
+        'maximo': max(amostras),
+    }
+
+
+async def medir_conexoes(opcoes_linha, quantidade):
+    cliente, eco = dois_hosts(opcoes_linha)
+    inicio = time.perf_counter()
+    for _ in range(quantidade):
+        conexao = await conectar(cliente, lambda c, d: None)
+        # RST em vez de FIN, para não deixar a conexão em TIME_WAIT
+        conexao.abortar()
+    segundos = time.perf_counter() - inicio
+    desmontar(cliente, eco)
+    return {'conexoes': quantidade, 'segundos': segundos, 'por_segundo': quantidade / segundos}
+
+
+def tempo_de_transmissao(opcoes_linha, n):
+    """
+    Tempo para transmitir n bytes numa linha (8N1: 10 bits por byte)
+    """
+    baud = opcoes_linha.get('baud')
+    return n * 10 / baud if baud else 0.
+
+
+def tempo_de_espera(opcoes_linha, quantidade, tamanho):
+    """
+    Tempos máximos de espera no teste de encaminhamento: pelo primeiro
+    datagrama e, depois, entre um datagrama e o seguinte. Os quadros saem
+    em blocos de até LIMIAR_DESCARGA bytes, e cada bloco só chega depois de
+    transmitido por inteiro em cada um dos dois enlaces.
+    """
+    quadro = tamanho + SOBRECARGA_QUADRO
+    latencia = 2 * opcoes_linha.get('latencia', 0.)
+    bloco = 2 * tempo_de_transmissao(opcoes_linha, LIMIAR_DESCARGA + quadro)
+    primeiro = SILENCIO + latencia + max(bloco, tempo_de_transmissao(opcoes_linha, quantidade * quadro))
+    return primeiro, SILENCIO + latencia + bloco
+
+
+async def medir_encaminhamento(opcoes_linha, quantidade, tamanho):
+    # Mesma topologia dos scripts placa1.py, placa2.py e placa3.py: o host
+    # 192.168.200.4 alcança o 192.168.200.2 através do roteador 192.168.200.3
+    a, r1 = par_de_linhas(**opcoes_linha)
+    r2, b = par_de_linhas(**opcoes_linha)
+    origem = montar_pilha('192.168.200.4', {'192.168.200.3': a},
+                          [('0.0.0.0/0', '192.168.200.3')])
+    montar_pilha('192.168.200.3', {'192.168.200.4': r1, '192.168.200.2': r2},
+                 [('192.168.200.0/24', '192.168.200.2'), ('192.168.200.4/32', '192.168.200.4')])
+    destino = montar_pilha('192.168.200.2', {'192.168.200.3': b},
+                           [('0.0.0.0/0', '192.168.200.3')])
+    recebidos = 0
+    ultimo = None
+    fim = asyncio.get_event_loop().create_future()
+
+    def recebedor(src_addr, dst_addr, segmento):
+        nonlocal recebidos, ultimo
+        recebidos += 1
+        ultimo = time.perf_counter()
+        if recebidos >= quantidade and not fim.done():
+            fim.set_result(None)
+
+    destino.registrar_recebedor(recebedor)
+    segmento = bytes(tamanho)
+    inicio = time.perf_counter()
+    for _ in range(quantidade):
+        origem.enviar(segmento, '192.168.200.2')
+    # Datagramas perdidos não são retransmitidos: termina quando todos
+    # chegarem ou quando nada chegar durante o tempo de espera
+    primeiro, seguintes = tempo_de_espera(opcoes_linha, quantidade, tamanho)
+    espera = primeiro
+    while not fim.done():
+        anterior = recebidos
+        await asyncio.wait([fim], timeout=espera)
+        if recebidos == anterior:
+            break
+        espera = seguintes
+    segundos = (ultimo or time.perf_counter()) - inicio
+    return {'datagramas': quantidade, 'recebidos': recebidos, 'tamanho': tamanho,
+            'segundos': segundos, 'datagramas_por_segundo': recebidos / segundos}
+
+
+def executar(nome, corrotina, tempo_limite):
+    registro.zerar()
+    try:
+        resultado = asyncio.run(asyncio.wait_for(corrotina, tempo_limite))
+    except asyncio.TimeoutError:
+        resultado = {'erro': 'tempo limite de %g s esgotado' % tempo_limite}
+    resultado['contadores'] = dict(registro.contadores)
+    print('%s: %s' % (nome, {k: v for k, v in resultado.items() if k != 'contadores'}),
+          file=sys.stderr)
+    return resultado
+
+
+def comparar(resultados, base, tolerancia):
+    """
+    Retorna a lista de medidas que pioraram mais do que a tolerância
+    (fração) em relação à base.
+    """
+    regressoes = []
+    for (teste, medida), maior_melhor in MEDIDAS.items():
+        atual = resultados.get(teste, {}).get(medida)
+        anterior = base.get('resultados', {}).get(teste, {}).get(medida)
+        if atual is None or not anterior:
+            continue
+        variacao = (atual - anterior) / anterior
+        if (maior_melhor and variacao < -tolerancia) or (not maior_melhor and variacao > tolerancia):
+            regressoes.append({'teste': teste, 'medida': medida, 'anterior': anterior,
+                               'atual': atual, 'variacao': variacao})
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark da pilha sobre linhas simuladas')
+    parser.add_argument('--baud', type=int, default=None, help='taxa das linhas (padrão: sem limite)')
+    parser.add_argument('--latencia', type=float, default=0., help='latência das linhas, em segundos')
+    parser.add_argument('--pedaco', type=int, default=None, help='bytes por leitura na linha')
+    parser.add_argument('--perda', type=float, default=0., help='probabilidade de perda de cada byte')
+    parser.add_argument('--corrupcao', type=float, default=0., help='probabilidade de corrupção de cada byte')
+    parser.add_argument('--semente', type=int, default=1)
+    parser.add_argument('--bytes-eco', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--mensagens', type=int, default=500)
+    parser.add_argument('--conexoes', type=int, default=500)
+    parser.add_argument('--datagramas', type=int, default=20000)
+    parser.add_argument('--tempo-limite', type=float, default=120.)
+    parser.add_argument('--saida', help='arquivo JSON de resultados (padrão: saída padrão)')
+    parser.add_argument('--comparar', help='arquivo JSON de resultados anterior')
+    parser.add_argument('--tolerancia', type=float, default=0.2)
+    args = parser.parse_args()
+
+    opcoes_linha = {'baud': args.baud, 'latencia': args.latencia, 'tamanho_pedaco': args.pedaco,
+                    'perda': args.perda, 'corrupcao': args.corrupcao, 'semente': args.semente}
+    resultados = {
+        'eco': executar('eco', medir_eco(opcoes_linha, args.bytes_eco), args.tempo_limite),
+        'latencia': executar('latencia', medir_latencia(opcoes_linha, args.mensagens, 32),
+                             args.tempo_limite),
+        'conexoes': executar('conexoes', medir_conexoes(opcoes_linha, args.conexoes),
+                             args.tempo_limite),
+        'encaminhamento': executar('encaminhamento',
+                                   medir_encaminhamento(opcoes_linha, args.datagramas, 64),
+                                   args.tempo_limite),
+    }
+    saida = {
+        'instante': time.time(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': opcoes_linha,
+        'resultados': resultados,
+    }
+    if args.comparar:
+        with open(args.comparar) as f:
+            saida['regressoes'] = comparar(resultados, json.load(f), args.tolerancia)
+
+    texto = json.dumps(saida, indent=2)
+    if args.saida:
+        with open(args.saida, 'w') as f:
+            f.write(texto + '\n')
+    else:
+        print(texto)
+    if saida.get('regressoes'):
+        for r in saida['regressoes']:
+            print('regressão: %(teste)s.%(medida)s %(anterior).4g -> %(atual).4g' % r, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,58 @@
 import os
+import math
 import mmap
 import errno
 import fcntl
-import struct
 import termios
+import random
 import asyncio
 import traceback
-from collections import defaultdict
+from collections import defaultdict, deque
+from metricas import registro
+
+
+# Taxa das linhas seriais (8N1: 10 bits por byte)
+BAUD = 115200
+# Capacidade, em bytes, da FIFO de transmissão de cada porta no hardware
+TAMANHO_FIFO_TX = 64
+# Máximo de bytes retirados da fila de recepção do hardware por interrupção
+ORCAMENTO_RX = 4096
+
+# Parâmetros padrão da PTY: tamanho de cada leitura e marcas d'água (em bytes
+# pendentes de escrita) para o controle de fluxo das camadas superiores
+TAMANHO_LEITURA_PTY = 2048
+MARCA_ALTA_PTY = 64 * 1024
+MARCA_BAIXA_PTY = 16 * 1024
 
 
 class ZyboSerialDriver:
     """ Driver para o hardware de https://github.com/thotypous/zybo-z7-20-uart """
 
-    def __init__(self, device='/dev/uio/user_io'):
+    def __init__(self, device='/dev/uio/user_io', baud=BAUD, tamanho_fifo_tx=TAMANHO_FIFO_TX,
+                 orcamento_rx=ORCAMENTO_RX):
         self.fd = os.open(device, os.O_RDWR)
         fcntl.fcntl(self.fd, fcntl.F_SETFL, os.O_NONBLOCK)
         self.mm = mmap.mmap(self.fd, 0x1000)
+        # Visões dos registradores de 32 bits, para ler e escrever sem
+        # struct.pack/unpack nem fatias do mmap
+        self.registradores = memoryview(self.mm).cast('I')
+        self.fila_rx = memoryview(self.mm).cast('i')
+        # Buffers de recepção por porta, reaproveitados a cada interrupção
+        self.orcamento_rx = orcamento_rx
+        self.buffers_rx = defaultdict(bytearray)
         asyncio.get_event_loop().add_reader(self.fd, self.__irq_handler)
         self.__irq_unmask()
         self.callbacks = defaultdict(lambda: lambda _: None)
+        # Fila de transmissão por porta. Como o hardware não informa a
+        # ocupação da FIFO, ela é estimada a partir da taxa da linha: cada
+        # porta só recebe tantos bytes quantos cabem na FIFO, e o restante é
+        # escrito mais tarde pelo laço de eventos, sem bloqueá-lo.
+        self.bytes_por_segundo = baud / 10
+        self.tamanho_fifo_tx = tamanho_fifo_tx
+        self.filas_tx = defaultdict(bytearray)
+        self.ocupacao_tx = defaultdict(float)
+        self.instante_tx = defaultdict(float)
+        self.drenagem_agendada = set()
 
     def obter_porta(self, port):
         """ Obtém uma porta para controlar a partir do software em Python """
@@ -32,28 +66,67 @@ class ZyboSerialDriver:
         return pty
 
     def enviar(self, port, data):
-        print('send', port, data)
-        for b in data:
-            self.mm[port*4:port*4+4] = struct.pack('I', b)
+        registro.contadores['serial.bytes_enviados'] += len(data)
+        self.filas_tx[port] += data
+        if port not in self.drenagem_agendada:
+            self.__drenar_tx(port)
+
+    def __drenar_tx(self, port):
+        self.drenagem_agendada.discard(port)
+        fila = self.filas_tx[port]
+        loop = asyncio.get_event_loop()
+        agora = loop.time()
+        ocupacao = max(0., self.ocupacao_tx[port] -
+                       (agora - self.instante_tx[port]) * self.bytes_por_segundo)
+        n = min(len(fila), int(self.tamanho_fifo_tx - ocupacao))
+        if n > 0:
+            registradores = self.registradores
+            for b in fila[:n]:
+                registradores[port] = b
+            del fila[:n]
+            ocupacao += n
+        self.ocupacao_tx[port] = ocupacao
+        self.instante_tx[port] = agora
+        if fila and port not in self.drenagem_agendada:
+            # volta quando a FIFO estiver com metade da capacidade livre
+            espera = (ocupacao - self.tamanho_fifo_tx / 2) / self.bytes_por_segundo
+            loop.call_later(max(0., espera), self.__drenar_tx, port)
+            self.drenagem_agendada.add(port)
 
     def registrar_recebedor(self, port, callback):
         self.callbacks[port] = callback
 
     def __irq_handler(self):
         os.read(self.fd, 4)   # diz ao SO que coletamos a irq
-        buffers = defaultdict(lambda: bytearray())
-        while True:
-            elem, = struct.unpack('i', self.mm[0:4])  # retira da fila do hardware
-            if elem == -1: break                      # fila vazia
-            port, b = elem>>8, elem&0xff
-            buffers[port].append(b)
+        self.__drenar_rx()
+
+    def __drenar_rx(self):
+        # Retira no máximo orcamento_rx bytes da fila do hardware. Se sobrar
+        # algo, o restante é retirado em outra iteração do laço de eventos,
+        # para que uma porta muito ativa não monopolize o processamento.
+        fila_rx = self.fila_rx
+        buffers = self.buffers_rx
+        for _ in range(self.orcamento_rx):
+            elem = fila_rx[0]            # retira da fila do hardware
+            if elem == -1:               # fila vazia
+                vazia = True
+                break
+            buffers[elem >> 8].append(elem & 0xff)
+        else:
+            vazia = False
         for port, dados in buffers.items():
+            if not dados:
+                continue
+            registro.contadores['serial.bytes_recebidos'] += len(dados)
             try:
-                print('recv', port, dados)
                 self.callbacks[port](bytes(dados))
             except:
                 traceback.print_exc()
-        self.__irq_unmask()
+            del dados[:]
+        if vazia:
+            self.__irq_unmask()
+        else:
+            asyncio.get_event_loop().call_soon(self.__drenar_rx)
 
     def __irq_unmask(self):
         os.write(self.fd, b'\x01\x00\x00\x00')
@@ -76,7 +149,8 @@ class ZyboSerialPort:
 
 
 class PTY:
-    def __init__(self):
+    def __init__(self, tamanho_leitura=TAMANHO_LEITURA_PTY,
+                 marca_alta=MARCA_ALTA_PTY, marca_baixa=MARCA_BAIXA_PTY):
         pty, slave_fd = os.openpty()
         iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(pty)
         ispeed = termios.B115200
@@ -97,11 +171,21 @@ class PTY:
         os.close(slave_fd)
         self.pty = pty
         self.pty_name = pty_name
+        self.callback = None
+        self.tamanho_leitura = tamanho_leitura
+        # Dados que o SO ainda não aceitou escrever. São escritos, todos de
+        # uma vez, quando a PTY voltar a ficar disponível para escrita.
+        self.saida = bytearray()
+        self.marca_alta = marca_alta
+        self.marca_baixa = marca_baixa
+        self.pausado = False
+        self.monitor_de_fluxo = None
         asyncio.get_event_loop().add_reader(pty, self.__raw_recv)
 
     def __raw_recv(self):
         try:
-            dados = os.read(self.pty, 2048)
+            dados = os.read(self.pty, self.tamanho_leitura)
+            registro.contadores['pty.bytes_recebidos'] += len(dados)
             if self.callback:
                 self.callback(dados)
         except OSError as e:
@@ -116,9 +200,186 @@ class PTY:
         """
         self.callback = callback
 
+    def registrar_monitor_de_fluxo(self, callback):
+        """
+        Registra uma função para ser chamada com True quando os dados pendentes
+        de escrita ultrapassarem a marca alta (a camada superior deve parar de
+        enviar) e com False quando voltarem à marca baixa.
+        """
+        self.monitor_de_fluxo = callback
+
     def enviar(self, dados):
         """
         Envia dados para a linha serial
         """
-        os.write(self.pty, dados)
+        registro.contadores['pty.bytes_enviados'] += len(dados)
+        if self.saida:
+            # já há dados esperando; preserva a ordem e escreve tudo junto
+            self.saida += dados
+        else:
+            n = self.__escrever(dados)
+            if n == len(dados):
+                return
+            self.saida += memoryview(dados)[n:]
+            asyncio.get_event_loop().add_writer(self.pty, self.__escrever_pendentes)
+        if not self.pausado and len(self.saida) > self.marca_alta:
+            self.pausado = True
+            registro.contadores['pty.pausas'] += 1
+            if self.monitor_de_fluxo:
+                self.monitor_de_fluxo(True)
+
+    def __escrever(self, dados):
+        try:
+            return os.write(self.pty, dados)
+        except BlockingIOError:
+            return 0
+        except OSError as e:
+            if e.errno == errno.EIO:
+                return len(dados)   # a outra ponta está fechada; descarta
+            raise e
+
+    def __escrever_pendentes(self):
+        n = self.__escrever(self.saida)
+        del self.saida[:n]
+        if not self.saida:
+            asyncio.get_event_loop().remove_writer(self.pty)
+        if self.pausado and len(self.saida) <= self.marca_baixa:
+            self.pausado = False
+            if self.monitor_de_fluxo:
+                self.monitor_de_fluxo(False)
+
+
+class LinhaVirtual:
+    """
+    Uma ponta de uma linha serial simulada dentro do próprio processo, com a
+    mesma interface de PTY e ZyboSerialPort. Use par_de_linhas para criar as
+    duas pontas de uma linha.
+    """
+
+    def __init__(self, baud=None, latencia=0., tamanho_pedaco=None, perda=0.,
+                 corrupcao=0., semente=None):
+        self.bytes_por_segundo = baud / 10 if baud else None
+        self.latencia = latencia
+        self.tamanho_pedaco = tamanho_pedaco
+        self.perda = perda
+        self.corrupcao = corrupcao
+        self.aleatorio = random.Random(semente)
+        self.outra_ponta = None
+        self.callback = None
+        self.livre_em = 0.      # instante em que a linha termina de transmitir
+        # Pedaços a caminho da outra ponta, com o instante de chegada de cada
+        # um. Os instantes nunca decrescem, e um único callback agendado
+        # entrega os pedaços, sempre na ordem em que foram enviados.
+        self.em_transito = deque()
+        self.entrega_agendada = False
+
+    def registrar_recebedor(self, callback):
+        """
+        Registra uma função para ser chamada quando vierem dados da linha serial
+        """
+        self.callback = callback
+
+    def enviar(self, dados):
+        """
+        Envia dados para a linha serial
+        """
+        registro.contadores['virtual.bytes_enviados'] += len(dados)
+        if self.outra_ponta is None:
+            return      # linha sem nada ligado na outra ponta
+        dados = self._degradar(bytes(dados))
+        loop = asyncio.get_event_loop()
+        agora = loop.time()
+        inicio = max(agora, self.livre_em)
+        n = len(dados)
+        passo = self.tamanho_pedaco or n or 1
+        em_transito = self.em_transito
+        for i in range(0, n, passo):
+            pedaco = dados[i:i+passo]
+            if self.bytes_por_segundo:
+                # cada pedaço chega quando o seu último byte tiver sido transmitido
+                chegada = inicio + (i + len(pedaco)) / self.bytes_por_segundo
+            else:
+                chegada = agora
+            chegada += self.latencia
+            if em_transito and chegada < em_transito[-1][0]:
+                # o temporizador do asyncio não preserva a ordem de instantes
+                # iguais, e a latência pode ter diminuído: nunca ultrapassar
+                chegada = em_transito[-1][0]
+            em_transito.append((chegada, pedaco))
+        if self.bytes_por_segundo:
+            self.livre_em = inicio + n / self.bytes_por_segundo
+        if em_transito and not self.entrega_agendada:
+            self._agendar_entrega(loop)
+
+    def _agendar_entrega(self, loop):
+        self.entrega_agendada = True
+        chegada = self.em_transito[0][0]
+        if chegada <= loop.time():
+            loop.call_soon(self._entregar_chegados, chegada)
+        else:
+            loop.call_at(chegada, self._entregar_chegados, chegada)
+
+    def _entregar_chegados(self, ate):
+        # Entrega, em ordem, os pedaços que chegam até o instante agendado (ou
+        # até agora, se o laço atrasou), sem depender de comparar instantes
+        # com o relógio, sujeitos a arredondamento
+        loop = asyncio.get_event_loop()
+        ate = max(ate, loop.time())
+        em_transito = self.em_transito
+        while em_transito and em_transito[0][0] <= ate:
+            self.outra_ponta._entregar(em_transito.popleft()[1])
+        if em_transito:
+            self._agendar_entrega(loop)
+        else:
+            self.entrega_agendada = False
+
+    def _proximo_erro(self, i, p):
+        # Salto geométrico até o próximo byte afetado, sem sortear byte a byte
+        if p >= 1:
+            return i
+        return i + int(math.log(1. - self.aleatorio.random()) / math.log(1. - p))
+
+    def _degradar(self, dados):
+        n = len(dados)
+        if self.corrupcao > 0:
+            buf = bytearray(dados)
+            i = self._proximo_erro(0, self.corrupcao)
+            while i < n:
+                buf[i] ^= 1 << self.aleatorio.randrange(8)
+                registro.contadores['virtual.bytes_corrompidos'] += 1
+                i = self._proximo_erro(i + 1, self.corrupcao)
+            dados = bytes(buf)
+        if self.perda > 0:
+            partes = []
+            inicio = 0
+            i = self._proximo_erro(0, self.perda)
+            while i < n:
+                partes.append(dados[inicio:i])
+                registro.contadores['virtual.bytes_perdidos'] += 1
+                inicio = i + 1
+                i = self._proximo_erro(inicio, self.perda)
+            partes.append(dados[inicio:])
+            dados = b''.join(partes)
+        return dados
+
+    def _entregar(self, dados):
+        registro.contadores['virtual.bytes_recebidos'] += len(dados)
+        if self.callback:
+            try:
+                self.callback(dados)
+            except:
+                traceback.print_exc()
+
 
+def par_de_linhas(semente=None, **opcoes):
+    """
+    Cria as duas pontas de uma linha serial simulada. As opções (baud,
+    latencia em segundos, tamanho_pedaco em bytes por leitura, e as
+    probabilidades de perda e de corrupção de cada byte) valem para os dois
+    sentidos. A semente torna a perda e a corrupção reprodutíveis.
+    """
+    a = LinhaVirtual(semente=semente, **opcoes)
+    b = LinhaVirtual(semente=None if semente is None else semente + 1, **opcoes)
+    a.outra_ponta = b
+    b.outra_ponta = a
+    return a, b
@@ -0,0 +1,187 @@
+"""
+Captura de pacotes no formato pcap (LINKTYPE_RAW: cada pacote é um
+datagrama IPv4, sem cabeçalho de enlace), legível pelo Wireshark e tcpdump.
+
+Uma Captura guarda os pacotes em um buffer circular de tamanho limitado, em
+memória: capturar um pacote custa só copiá-lo (se não for imutável) e
+anexá-lo a uma fila, e quando o limite é atingido os mais antigos são
+descartados. Os pacotes só são formatados e escritos em disco, todos de uma
+vez, quando a captura é descarregada, seja sob demanda, periodicamente ou ao
+receber um sinal. Assim ela pode ficar ligada durante o uso normal.
+
+A captura pode ser ligada em cada Enlace de uma CamadaEnlace (vide
+CamadaEnlace.capturar), vendo os datagramas que passam por aquele enlace, ou
+na camada IP (vide IP.capturar), vendo os datagramas recebidos (destinados a
+este host ou a encaminhar) e os enviados por ela.
+
+Exemplo:
+    captura = Captura('placa2.pcap', filtro=criar_filtro(porta=7000))
+    captura.descarregar_ao_receber_sinal()      # kill -USR1 <pid>
+    rede.capturar(captura)
+"""
+
+import os
+import time
+import signal
+import struct
+import asyncio
+import traceback
+from collections import deque
+from iputils import str2addr, IPPROTO_TCP
+
+# Cabeçalho global do arquivo pcap: número mágico, versão 2.4, fuso horário,
+# precisão dos instantes, snaplen e tipo de enlace
+CABECALHO_PCAP = '<IHHiIII'
+MAGICO_PCAP = 0xa1b2c3d4
+LINKTYPE_RAW = 101
+
+# Cabeçalho de cada pacote: segundos, microssegundos, bytes guardados e
+# tamanho original
+CABECALHO_PACOTE = struct.Struct('<IIII')
+
+# Tamanho padrão, em bytes, do buffer circular (contando os cabeçalhos pcap)
+CAPACIDADE = 4 * 1024 * 1024
+
+# Maior quantidade de bytes guardada de cada pacote
+SNAPLEN = 65535
+
+
+def criar_filtro(endereco=None, porta=None, protocolo=None):
+    """
+    Cria uma função que decide, olhando só os bytes do datagrama, se ele
+    deve ser capturado. Como no tcpdump ('host', 'net', 'port' e 'proto'),
+    o endereco (no formato 'x.y.z.w' ou 'x.y.z.w/n') e a porta casam tanto
+    com a origem quanto com o destino. A porta só é testada em segmentos TCP
+    (e primeiros fragmentos). Critérios omitidos não restringem a captura.
+    """
+    if endereco is not None:
+        endereco, _, n = endereco.partition('/')
+        n = int(n or 32)
+        mascara = (0xffffffff << (32 - n)) & 0xffffffff
+        rede = int.from_bytes(str2addr(endereco), 'big') & mascara
+    if porta is not None:
+        porta_bin = porta.to_bytes(2, 'big')
+
+    def filtro(datagrama):
+        if protocolo is not None and datagrama[9] != protocolo:
+            return False
+        if endereco is not None and \
+                int.from_bytes(datagrama[12:16], 'big') & mascara != rede and \
+                int.from_bytes(datagrama[16:20], 'big') & mascara != rede:
+            return False
+        if porta is not None:
+            if datagrama[9] != IPPROTO_TCP or (datagrama[6] & 0x1f) or datagrama[7]:
+                return False
+            ihl = (datagrama[0] & 0xf) * 4
+            if datagrama[ihl:ihl+2] != porta_bin and datagrama[ihl+2:ihl+4] != porta_bin:
+                return False
+        return True
+
+    return filtro
+
+
+class Captura:
+    def __init__(self, caminho, capacidade=CAPACIDADE, filtro=None, snaplen=SNAPLEN,
+                 relogio=time.time):
+        """
+        Cria uma captura que, ao ser descarregada, acrescenta os pacotes ao
+        arquivo pcap em caminho (criado, com o cabeçalho pcap, se não existir
+        ou estiver vazio). A capacidade limita, em bytes, a memória ocupada
+        pelos pacotes ainda não descarregados. O filtro, opcional, é uma
+        função como as criadas por criar_filtro. O relogio fornece o instante
+        de cada pacote (use loop.time em simulações, vide simulador.py).
+        """
+        self.caminho = caminho
+        self.capacidade = capacidade
+        self.filtro = filtro
+        self.snaplen = snaplen
+        self.relogio = relogio
+        self.pacotes = deque()      # (instante, tamanho original, bytes)
+        self.ocupado = 0
+        self.capturados = 0
+        self.sobrescritos = 0       # descartados por falta de espaço no buffer
+        self.descarga_periodica = None
+
+    def __call__(self, datagrama):
+        """
+        Registra um datagrama, se ele passar pelo filtro
+        """
+        if self.filtro is not None and not self.filtro(datagrama):
+            return
+        tamanho = len(datagrama)
+        if tamanho > self.snaplen:
+            datagrama = datagrama[:self.snaplen]
+        # Quem chamou pode reaproveitar um buffer mutável depois
+        dados = bytes(datagrama)
+        self.pacotes.append((self.relogio(), tamanho, dados))
+        self.ocupado += len(dados) + CABECALHO_PACOTE.size
+        self.capturados += 1
+        while self.ocupado > self.capacidade:
+            _, _, antigo = self.pacotes.popleft()
+            self.ocupado -= len(antigo) + CABECALHO_PACOTE.size
+            self.sobrescritos += 1
+
+    def __len__(self):
+        return len(self.pacotes)
+
+    def descarregar(self):
+        """
+        Acrescenta ao arquivo, em uma única escrita, todos os pacotes
+        guardados no buffer, que é esvaziado.
+        """
+        pacotes = self.pacotes
+        self.pacotes = deque()
+        self.ocupado = 0
+        partes = []
+        empacotar = CABECALHO_PACOTE.pack
+        for instante, tamanho, dados in pacotes:
+            segundos = int(instante)
+            partes.append(empacotar(segundos, int((instante - segundos) * 1e6),
+                                    len(dados), tamanho))
+            partes.append(dados)
+        with open(self.caminho, 'ab') as f:
+            if f.tell() == 0:
+                f.write(struct.pack(CABECALHO_PCAP, MAGICO_PCAP, 2, 4, 0, 0,
+                                    self.snaplen, LINKTYPE_RAW))
+            f.write(b''.join(partes))
+
+    def _descarregar_protegido(self):
+        try:
+            self.descarregar()
+        except:
+            traceback.print_exc()
+
+    def iniciar_descarga_periodica(self, intervalo):
+        """
+        Descarrega a captura a cada intervalo segundos, no laço de eventos
+        """
+        def tique():
+            self._descarregar_protegido()
+            self.descarga_periodica = loop.call_later(intervalo, tique)
+
+        self.parar_descarga_periodica()
+        loop = asyncio.get_event_loop()
+        self.descarga_periodica = loop.call_later(intervalo, tique)
+
+    def parar_descarga_periodica(self):
+        if self.descarga_periodica is not None:
+            self.descarga_periodica.cancel()
+            self.descarga_periodica = None
+
+    def descarregar_ao_receber_sinal(self, sinal=signal.SIGUSR1):
+        """
+        Descarrega a captura sempre que o processo receber o sinal dado. A
+        escrita acontece no laço de eventos, nunca no meio do tratamento de
+        um pacote.
+        """
+        asyncio.get_event_loop().add_signal_handler(sinal, self._descarregar_protegido)
+
+    def estatisticas(self):
+        return {
+            'caminho': os.path.abspath(self.caminho),
+            'pacotes': len(self.pacotes),
+            'ocupado': self.ocupado,
+            'capacidade': self.capacidade,
+            'capturados': self.capturados,
+            'sobrescritos': self.sobrescritos,
+        }
@@ -0,0 +1,97 @@
+"""
+Implementação acelerada do checksum complemento-de-um usado pelo TCP e pelo IP.
+
+As funções calc_checksum e fix_checksum deste módulo têm a mesma assinatura e
+produzem exatamente os mesmos resultados que as de tcputils.py (que não pode
+ser editado), mas somam o buffer inteiro de uma só vez em vez de percorrê-lo
+de dois em dois bytes.
+
+A soma complemento-de-um de palavras de 16 bits é congruente, módulo 0xffff,
+ao próprio buffer lido como um inteiro big-endian (pois 2**16 = 1 mod 0xffff).
+Por isso basta um int.from_bytes seguido de um resto de divisão, ambos feitos
+em C. Se o NumPy estiver disponível, buffers grandes são somados por ele.
+"""
+
+import struct
+from functools import lru_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A partir deste tamanho (em bytes), vale a pena pagar o custo fixo do NumPy
+LIMIAR_NUMPY = 1 << 16
+
+
+def soma_palavras(dados, soma=0):
+    """
+    Acumula em soma as palavras de 16 bits (big-endian) de dados, que pode ser
+    bytes, bytearray ou memoryview. Se o tamanho for ímpar, considera um
+    padding de um byte nulo à direita. O resultado não é dobrado: use
+    finalizar para obter o checksum.
+    """
+    n = len(dados)
+    if numpy is not None and n >= LIMIAR_NUMPY:
+        pares = n & ~1
+        soma += int(numpy.frombuffer(dados, dtype='>u2', count=pares // 2)
+                    .sum(dtype=numpy.uint64))
+        if n & 1:
+            soma += dados[-1] << 8
+        return soma
+    total = int.from_bytes(dados, 'big')
+    if n & 1:
+        total <<= 8
+    # Reduz módulo 0xffff, preservando a distinção entre "soma zero" e
+    # "soma múltipla de 0xffff" (que no complemento de um vale 0xffff)
+    if total:
+        total = total % 0xffff or 0xffff
+    return soma + total
+
+
+def finalizar(soma):
+    """
+    Dobra os carries de uma soma de palavras e retorna o seu complemento,
+    ou seja, o valor a ser gravado no campo de checksum.
+    """
+    if soma:
+        soma = soma % 0xffff or 0xffff
+    return ~soma & 0xffff
+
+
+@lru_cache(maxsize=64)
+def _soma_endereco(addr):
+    a, b, c, d = addr.split('.')
+    return ((int(a) << 8) | int(b)) + ((int(c) << 8) | int(d))
+
+
+def soma_pseudocabecalho(src_addr, dst_addr, comprimento, protocolo=0x0006):
+    """
+    Soma das palavras do pseudocabeçalho TCP/UDP, calculada diretamente dos
+    campos, sem construir (nem concatenar) um objeto bytes.
+    """
+    return _soma_endereco(src_addr) + _soma_endereco(dst_addr) + protocolo + comprimento
+
+
+def calc_checksum(segment, src_addr=None, dst_addr=None):
+    """
+    Calcula o checksum complemento-de-um (formato do TCP e do UDP) para os
+    dados fornecidos. Equivalente a tcputils.calc_checksum.
+
+    Os endereços IPv4, se passados, devem ser strings (no formato x.y.z.w)
+    e são incluídos por meio do pseudocabeçalho.
+    """
+    if src_addr is None and dst_addr is None:
+        return finalizar(soma_palavras(segment))
+    soma = soma_pseudocabecalho(src_addr, dst_addr, len(segment))
+    return finalizar(soma_palavras(segment, soma))
+
+
+def fix_checksum(segment, src_addr, dst_addr):
+    """
+    Corrige o checksum de um segmento TCP. Equivalente a tcputils.fix_checksum.
+    """
+    seg = bytearray(segment)
+    seg[16:18] = b'\x00\x00'
+    struct.pack_into('!H', seg, 16, calc_checksum(seg, src_addr, dst_addr))
+    return bytes(seg)
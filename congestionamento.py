@@ -0,0 +1,141 @@
+"""
+Algoritmos de controle de congestionamento para o TCP (vide tcp.py).
+
+Cada Conexao instancia um objeto de uma das classes abaixo, escolhida pelo
+Servidor, e o consulta para saber quantos bytes podem estar em voo
+(atributo cwnd). A Conexao avisa o algoritmo sempre que chegam novas
+confirmações, quando o temporizador de retransmissão expira e quando uma
+perda é detectada por ACKs duplicados.
+"""
+
+from abc import ABC, abstractmethod
+
+
+class ControleCongestionamento(ABC):
+    """
+    Interface comum aos algoritmos. Os tamanhos são sempre em bytes e os
+    instantes, em segundos.
+    """
+
+    def __init__(self, mss):
+        self.mss = mss
+        self.cwnd = 2 * mss
+        self.ssthresh = 64 * 1024
+
+    @abstractmethod
+    def ao_confirmar(self, confirmados, agora, rtt):
+        """
+        Chamado quando um ACK confirma confirmados bytes novos.
+        """
+
+    @abstractmethod
+    def ao_detectar_perda(self, em_voo, agora):
+        """
+        Chamado quando uma perda é detectada por ACKs duplicados (fast
+        retransmit). Retorna a nova janela.
+        """
+
+    def ao_expirar(self, em_voo, agora):
+        """
+        Chamado quando o temporizador de retransmissão expira.
+        """
+        self.ssthresh = max(em_voo // 2, 2 * self.mss)
+        self.cwnd = self.mss
+
+
+class Reno(ControleCongestionamento):
+    """
+    TCP Reno (RFC 5681): slow start, congestion avoidance com crescimento
+    de um MSS por RTT e redução da janela à metade a cada perda.
+    """
+
+    def __init__(self, mss):
+        super().__init__(mss)
+        self.acumulado = 0
+
+    def ao_confirmar(self, confirmados, agora, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += min(confirmados, self.mss)
+        else:
+            self.acumulado += confirmados
+            if self.acumulado >= self.cwnd:
+                self.acumulado -= self.cwnd
+                self.cwnd += self.mss
+
+    def ao_detectar_perda(self, em_voo, agora):
+        self.ssthresh = max(em_voo // 2, 2 * self.mss)
+        self.cwnd = self.ssthresh
+        self.acumulado = 0
+        return self.cwnd
+
+    def ao_expirar(self, em_voo, agora):
+        super().ao_expirar(em_voo, agora)
+        self.acumulado = 0
+
+
+class Cubic(ControleCongestionamento):
+    """
+    CUBIC (RFC 8312): após uma perda, a janela segue uma função cúbica do
+    tempo decorrido, centrada na janela em que a perda ocorreu, o que a torna
+    independente do RTT. Inclui a região "amigável ao TCP", na qual a janela
+    nunca cresce mais devagar do que cresceria com o Reno.
+    """
+
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss):
+        super().__init__(mss)
+        self.w_max = 0.
+        self.k = 0.
+        self.inicio_epoca = None
+        self.w_origem = 0.
+        self.w_est = 0.
+
+    def _iniciar_epoca(self, agora):
+        self.inicio_epoca = agora
+        w = self.cwnd / self.mss
+        if w < self.w_max:
+            self.k = ((self.w_max - w) / self.C) ** (1 / 3)
+            origem = self.w_max
+        else:
+            self.k = 0.
+            origem = w
+        self.w_origem = origem
+        self.w_est = w
+
+    def ao_confirmar(self, confirmados, agora, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += min(confirmados, self.mss)
+            return
+        if self.inicio_epoca is None:
+            self._iniciar_epoca(agora)
+        t = agora - self.inicio_epoca
+        alvo = self.w_origem + self.C * (t - self.k) ** 3
+        # Estimativa da janela que o Reno teria no mesmo instante
+        w = self.cwnd / self.mss
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * confirmados / self.mss / w
+        alvo = max(alvo, self.w_est)
+        if alvo > w:
+            self.cwnd += int(self.mss * (alvo - w) / w * confirmados / self.mss) or 1
+
+    def _reduzir(self):
+        w = self.cwnd / self.mss
+        # Convergência rápida: se a perda ocorreu abaixo do máximo anterior,
+        # outro fluxo provavelmente chegou, então libera banda para ele
+        if w < self.w_max:
+            self.w_max = w * (1 + self.BETA) / 2
+        else:
+            self.w_max = w
+        self.inicio_epoca = None
+
+    def ao_detectar_perda(self, em_voo, agora):
+        self._reduzir()
+        self.cwnd = max(int(self.cwnd * self.BETA), 2 * self.mss)
+        self.ssthresh = self.cwnd
+        return self.cwnd
+
+    def ao_expirar(self, em_voo, agora):
+        self._reduzir()
+        self.ssthresh = max(int(self.cwnd * self.BETA), 2 * self.mss)
+        self.cwnd = self.mss
@@ -0,0 +1,347 @@
+"""
+Compressão de cabeçalhos TCP/IP de Van Jacobson (RFC 1144), também conhecida
+como CSLIP.
+
+Cada ponta de um enlace guarda, para até N conexões TCP ativas, uma cópia do
+último cabeçalho transmitido ou recebido. Em vez dos 40 bytes de cabeçalho,
+cada datagrama passa a levar apenas as diferenças em relação à cópia guardada,
+o que normalmente cabe em 3 a 5 bytes.
+
+O tipo do pacote é indicado no primeiro byte do quadro SLIP:
+
+ * TYPE_IP: datagrama comum, sem nenhuma alteração (primeiro byte 0x4X).
+ * TYPE_UNCOMPRESSED_TCP: datagrama TCP completo, porém com o campo protocolo
+   substituído pelo número do slot e o nibble de versão trocado por 7. Serve
+   para (re)sincronizar o estado do slot na outra ponta.
+ * TYPE_COMPRESSED_TCP: bit mais significativo em 1, seguido dos campos que
+   mudaram.
+"""
+
+import struct
+from checksum import calc_checksum
+
+TYPE_IP = 0x40
+TYPE_UNCOMPRESSED_TCP = 0x70
+TYPE_COMPRESSED_TCP = 0x80
+
+# Bits do byte de mudanças de um pacote comprimido
+NEW_C = 0x40
+NEW_I = 0x20
+TCP_PUSH_BIT = 0x10
+NEW_S = 0x08
+NEW_A = 0x04
+NEW_W = 0x02
+NEW_U = 0x01
+
+# Combinações que nunca ocorrem naturalmente e que por isso codificam casos
+# especiais frequentes
+SPECIAL_I = NEW_S | NEW_W | NEW_U     # tráfego interativo ecoado
+SPECIAL_D = NEW_S | NEW_A | NEW_W | NEW_U   # transferência unidirecional
+SPECIALS_MASK = SPECIAL_D
+
+TH_FIN = 0x01
+TH_SYN = 0x02
+TH_RST = 0x04
+TH_PUSH = 0x08
+TH_ACK = 0x10
+TH_URG = 0x20
+
+IPPROTO_TCP = 6
+
+SLOTS = 16
+
+
+def _codificar(saida, n):
+    # Valores de 1 a 255 ocupam um byte; os demais (inclusive 0), três
+    if 0 < n < 256:
+        saida.append(n)
+    else:
+        saida.append(0)
+        saida.append((n >> 8) & 0xff)
+        saida.append(n & 0xff)
+
+
+def _decodificar(dados, i):
+    if dados[i] == 0:
+        return (dados[i+1] << 8) | dados[i+2], i + 3
+    return dados[i], i + 1
+
+
+def _tamanhos(cabecalho):
+    ihl = (cabecalho[0] & 0x0f) * 4
+    return ihl, ihl + (cabecalho[ihl + 12] >> 4) * 4
+
+
+class Compressor:
+    """
+    Lado transmissor da compressão. O método comprimir recebe um datagrama
+    IPv4 e retorna o quadro a ser enviado pelo enlace.
+    """
+
+    def __init__(self, slots=SLOTS):
+        self.slots = slots
+        self.estados = {}      # (src, dst, portas) -> número do slot
+        self.cabecalhos = [None] * slots
+        self.lru = []          # números de slot, do usado há mais tempo ao mais recente
+        self.ultimo = None
+        self.comprimidos = 0
+        self.nao_comprimidos = 0
+        self.tipo_ip = 0
+
+    def _obter_slot(self, chave):
+        slot = self.estados.get(chave)
+        if slot is not None:
+            self.lru.remove(slot)
+            self.lru.append(slot)
+            return slot, True
+        if len(self.lru) < self.slots:
+            slot = len(self.lru)
+        else:
+            slot = self.lru.pop(0)
+            for k, v in self.estados.items():
+                if v == slot:
+                    del self.estados[k]
+                    break
+        self.estados[chave] = slot
+        self.lru.append(slot)
+        return slot, False
+
+    def comprimir(self, datagrama):
+        if len(datagrama) < 40 or datagrama[9] != IPPROTO_TCP:
+            self.tipo_ip += 1
+            return datagrama
+        ihl = (datagrama[0] & 0x0f) * 4
+        # Fragmentos e segmentos de controle (SYN, FIN, RST, sem ACK) passam
+        # sem compressão, como recomenda a RFC
+        if (datagrama[6] & 0x3f) or datagrama[7] or len(datagrama) < ihl + 20 or \
+                datagrama[ihl + 13] & (TH_SYN | TH_FIN | TH_RST | TH_ACK) != TH_ACK:
+            self.tipo_ip += 1
+            return datagrama
+        hlen = ihl + (datagrama[ihl + 12] >> 4) * 4
+        if len(datagrama) < hlen:
+            self.tipo_ip += 1
+            return datagrama
+
+        chave = bytes(datagrama[12:20]) + bytes(datagrama[ihl:ihl + 4])
+        slot, conhecido = self._obter_slot(chave)
+        antigo = self.cabecalhos[slot]
+        if not conhecido or antigo is None or len(antigo) != hlen or \
+                datagrama[0:2] != antigo[0:2] or datagrama[6:10] != antigo[6:10] or \
+                datagrama[20:ihl] != antigo[20:ihl] or \
+                datagrama[ihl + 20:hlen] != antigo[ihl + 20:hlen]:
+            return self._nao_comprimido(datagrama, slot, hlen)
+
+        saida = bytearray()
+        mudancas = 0
+        flags = datagrama[ihl + 13]
+        urg, = struct.unpack_from('!H', datagrama, ihl + 18)
+        urg_antigo, = struct.unpack_from('!H', antigo, ihl + 18)
+        if flags & TH_URG:
+            _codificar(saida, urg)
+            mudancas |= NEW_U
+        elif urg != urg_antigo:
+            return self._nao_comprimido(datagrama, slot, hlen)
+
+        janela, = struct.unpack_from('!H', datagrama, ihl + 14)
+        janela_antiga, = struct.unpack_from('!H', antigo, ihl + 14)
+        delta = (janela - janela_antiga) & 0xffff
+        if delta:
+            _codificar(saida, delta)
+            mudancas |= NEW_W
+
+        seq, ack = struct.unpack_from('!II', datagrama, ihl + 4)
+        seq_antigo, ack_antigo = struct.unpack_from('!II', antigo, ihl + 4)
+        delta_a = (ack - ack_antigo) & 0xffffffff
+        if delta_a:
+            if delta_a > 0xffff:
+                return self._nao_comprimido(datagrama, slot, hlen)
+            _codificar(saida, delta_a)
+            mudancas |= NEW_A
+        delta_s = (seq - seq_antigo) & 0xffffffff
+        if delta_s:
+            if delta_s > 0xffff:
+                return self._nao_comprimido(datagrama, slot, hlen)
+            _codificar(saida, delta_s)
+            mudancas |= NEW_S
+
+        tam, = struct.unpack_from('!H', datagrama, 2)
+        tam_antigo, = struct.unpack_from('!H', antigo, 2)
+        dados_antigos = tam_antigo - hlen
+        if mudancas == 0:
+            # Nada mudou. Se o pacote anterior não tinha dados e este tem, é o
+            # caso comum de dados após um ACK; do contrário é provavelmente uma
+            # retransmissão, que vai sem compressão para ressincronizar.
+            if not (tam != tam_antigo and dados_antigos == 0):
+                return self._nao_comprimido(datagrama, slot, hlen)
+        elif mudancas in (SPECIAL_I, SPECIAL_D):
+            return self._nao_comprimido(datagrama, slot, hlen)
+        elif mudancas == NEW_S | NEW_A:
+            if delta_s == delta_a and delta_s == dados_antigos:
+                mudancas = SPECIAL_I
+                del saida[:]
+        elif mudancas == NEW_S:
+            if delta_s == dados_antigos:
+                mudancas = SPECIAL_D
+                del saida[:]
+
+        ident, = struct.unpack_from('!H', datagrama, 4)
+        ident_antigo, = struct.unpack_from('!H', antigo, 4)
+        delta = (ident - ident_antigo) & 0xffff
+        if delta != 1:
+            _codificar(saida, delta)
+            mudancas |= NEW_I
+        if flags & TH_PUSH:
+            mudancas |= TCP_PUSH_BIT
+
+        self.cabecalhos[slot] = bytes(datagrama[:hlen])
+        cabeca = bytearray()
+        if slot != self.ultimo:
+            self.ultimo = slot
+            cabeca.append(TYPE_COMPRESSED_TCP | NEW_C | mudancas)
+            cabeca.append(slot)
+        else:
+            cabeca.append(TYPE_COMPRESSED_TCP | mudancas)
+        cabeca += datagrama[ihl + 16:ihl + 18]   # checksum TCP vai sempre
+        cabeca += saida
+        cabeca += datagrama[hlen:]
+        self.comprimidos += 1
+        return cabeca
+
+    def _nao_comprimido(self, datagrama, slot, hlen):
+        self.cabecalhos[slot] = bytes(datagrama[:hlen])
+        self.ultimo = slot
+        quadro = bytearray(datagrama)
+        quadro[0] = TYPE_UNCOMPRESSED_TCP | (quadro[0] & 0x0f)
+        quadro[9] = slot
+        self.nao_comprimidos += 1
+        return quadro
+
+
+class Descompressor:
+    """
+    Lado receptor da compressão. O método descomprimir recebe um quadro
+    vindo do enlace e retorna o datagrama IPv4 reconstruído, ou None se o
+    quadro tiver de ser descartado.
+    """
+
+    def __init__(self, slots=SLOTS):
+        self.slots = slots
+        self.cabecalhos = [None] * slots
+        self.ultimo = None
+        # Após um erro no enlace, descarta pacotes comprimidos até receber um
+        # que informe explicitamente o slot (NEW_C) ou um não comprimido
+        self.descartando = False
+        self.erros = 0
+
+    def erro(self):
+        """
+        Avisa que um quadro foi perdido ou corrompido no enlace.
+        """
+        self.descartando = True
+
+    def descomprimir(self, quadro):
+        if not quadro:
+            return None
+        tipo = quadro[0]
+        if tipo & TYPE_COMPRESSED_TCP:
+            return self._comprimido(quadro)
+        if tipo & 0xf0 == TYPE_UNCOMPRESSED_TCP:
+            return self._nao_comprimido(quadro)
+        return quadro
+
+    def _falha(self):
+        self.erros += 1
+        self.descartando = True
+        return None
+
+    def _nao_comprimido(self, quadro):
+        slot = quadro[9]
+        if slot >= self.slots or len(quadro) < 40:
+            return self._falha()
+        datagrama = bytearray(quadro)
+        datagrama[0] = 0x40 | (datagrama[0] & 0x0f)
+        datagrama[9] = IPPROTO_TCP
+        ihl, hlen = _tamanhos(datagrama)
+        if len(datagrama) < hlen:
+            return self._falha()
+        self.cabecalhos[slot] = bytes(datagrama[:hlen])
+        self.ultimo = slot
+        self.descartando = False
+        return bytes(datagrama)
+
+    def _comprimido(self, quadro):
+        try:
+            return self._reconstruir(quadro)
+        except IndexError:
+            return self._falha()
+
+    def _reconstruir(self, quadro):
+        mudancas = quadro[0]
+        i = 1
+        if mudancas & NEW_C:
+            slot = quadro[1]
+            i = 2
+            if slot >= self.slots or self.cabecalhos[slot] is None:
+                return self._falha()
+            self.ultimo = slot
+            self.descartando = False
+        elif self.descartando or self.ultimo is None:
+            self.erros += 1
+            return None
+        slot = self.ultimo
+        antigo = self.cabecalhos[slot]
+        ihl, hlen = _tamanhos(antigo)
+        if len(quadro) < i + 2:
+            return self._falha()
+        cab = bytearray(antigo)
+        cab[ihl + 16:ihl + 18] = quadro[i:i + 2]
+        i += 2
+        if mudancas & TCP_PUSH_BIT:
+            cab[ihl + 13] |= TH_PUSH
+        else:
+            cab[ihl + 13] &= ~TH_PUSH & 0xff
+
+        seq, ack = struct.unpack_from('!II', cab, ihl + 4)
+        tam_antigo, = struct.unpack_from('!H', cab, 2)
+        especial = mudancas & SPECIALS_MASK
+        if especial == SPECIAL_I:
+            n = tam_antigo - hlen
+            seq += n
+            ack += n
+        elif especial == SPECIAL_D:
+            seq += tam_antigo - hlen
+        else:
+            if mudancas & NEW_U:
+                cab[ihl + 13] |= TH_URG
+                urg, i = _decodificar(quadro, i)
+                struct.pack_into('!H', cab, ihl + 18, urg)
+            else:
+                cab[ihl + 13] &= ~TH_URG & 0xff
+            if mudancas & NEW_W:
+                delta, i = _decodificar(quadro, i)
+                janela, = struct.unpack_from('!H', cab, ihl + 14)
+                struct.pack_into('!H', cab, ihl + 14, (janela + delta) & 0xffff)
+            if mudancas & NEW_A:
+                delta, i = _decodificar(quadro, i)
+                ack += delta
+            if mudancas & NEW_S:
+                delta, i = _decodificar(quadro, i)
+                seq += delta
+        struct.pack_into('!II', cab, ihl + 4, seq & 0xffffffff, ack & 0xffffffff)
+
+        ident, = struct.unpack_from('!H', cab, 4)
+        if mudancas & NEW_I:
+            delta, i = _decodificar(quadro, i)
+            ident += delta
+        else:
+            ident += 1
+        struct.pack_into('!H', cab, 4, ident & 0xffff)
+
+        if i > len(quadro):
+            return self._falha()
+        struct.pack_into('!H', cab, 2, hlen + len(quadro) - i)
+        cab[10:12] = b'\x00\x00'
+        struct.pack_into('!H', cab, 10, calc_checksum(cab[:ihl]))
+        self.cabecalhos[slot] = bytes(cab)
+        cab += quadro[i:]
+        return bytes(cab)
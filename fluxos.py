@@ -0,0 +1,174 @@
+"""
+Adaptadores para usar as conexões de tcp.py com as abstrações do asyncio.
+
+Transporte implementa a interface asyncio.Transport sobre uma Conexao, de
+modo que qualquer asyncio.Protocol possa ser usado como aplicação. Com ele,
+iniciar_servidor oferece o equivalente a asyncio.start_server: cada conexão
+aceita é entregue como um par (StreamReader, StreamWriter).
+
+O controle de fluxo é repassado nos dois sentidos: o protocolo recebe
+pause_writing quando o buffer de envio da conexão passa da marca alta (o que
+faz StreamWriter.drain esperar), e pause_reading do transporte pausa a
+leitura da conexão, fazendo a janela anunciada ao outro lado encolher.
+"""
+
+import asyncio
+import traceback
+from tcp import Servidor, FECHADA, TIME_WAIT, MARCA_ALTA_ENVIO
+
+# Limite padrão, em bytes, do buffer de cada StreamReader
+LIMITE_LEITOR = 64 * 1024
+
+
+class Transporte(asyncio.Transport):
+    def __init__(self, conexao, protocolo):
+        super().__init__()
+        self.conexao = conexao
+        self.protocolo = protocolo
+        self.fechando = False
+        self.perdido = False
+        conexao.registrar_recebedor(self._dados_recebidos)
+        conexao.registrar_monitor_de_fluxo(self._fluxo)
+        conexao.registrar_monitor_de_estado(self._estado)
+
+    def _dados_recebidos(self, conexao, dados):
+        if self.fechando:
+            return
+        try:
+            if dados:
+                self.protocolo.data_received(dados)
+            elif conexao.estado == FECHADA:
+                # A conexão foi abortada (RST, ociosidade ou retransmissões demais)
+                self.fechando = True
+                self._perder(ConnectionResetError('conexão abortada'))
+            elif not self.protocolo.eof_received():
+                self.close()
+        except:
+            traceback.print_exc()
+
+    def _fluxo(self, pausar):
+        try:
+            if pausar:
+                self.protocolo.pause_writing()
+            else:
+                self.protocolo.resume_writing()
+        except:
+            traceback.print_exc()
+
+    def _estado(self, conexao, estado):
+        # Depois de close, a conexão só está perdida quando os dados
+        # pendentes e o FIN já tiverem sido enviados e confirmados
+        if self.fechando and estado in (FECHADA, TIME_WAIT):
+            asyncio.get_event_loop().call_soon(self._perder, None)
+
+    def _perder(self, exc):
+        if self.perdido:
+            return
+        self.perdido = True
+        try:
+            self.protocolo.connection_lost(exc)
+        except:
+            traceback.print_exc()
+
+    # Interface de asyncio.BaseTransport
+
+    def get_extra_info(self, name, default=None):
+        src_addr, src_port, dst_addr, dst_port = self.conexao.id_conexao
+        if name == 'peername':
+            return (src_addr, src_port)
+        if name == 'sockname':
+            return (dst_addr, dst_port)
+        return default
+
+    def is_closing(self):
+        return self.fechando
+
+    def close(self):
+        if self.fechando:
+            return
+        self.fechando = True
+        self.conexao.fechar()
+        if self.conexao.estado in (FECHADA, TIME_WAIT):
+            asyncio.get_event_loop().call_soon(self._perder, None)
+
+    def set_protocol(self, protocol):
+        self.protocolo = protocol
+
+    def get_protocol(self):
+        return self.protocolo
+
+    # Interface de asyncio.ReadTransport
+
+    def is_reading(self):
+        return not self.conexao.leitura_pausada
+
+    def pause_reading(self):
+        self.conexao.pausar_leitura()
+
+    def resume_reading(self):
+        self.conexao.retomar_leitura()
+
+    # Interface de asyncio.WriteTransport
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = MARCA_ALTA_ENVIO if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self.conexao.definir_marcas_envio(high, low)
+
+    def get_write_buffer_limits(self):
+        return (self.conexao.marca_baixa, self.conexao.marca_alta)
+
+    def get_write_buffer_size(self):
+        return self.conexao.bytes_pendentes
+
+    def write(self, data):
+        if self.fechando:
+            return
+        self.conexao.enviar(data)
+
+    def writelines(self, list_of_data):
+        self.write(b''.join(list_of_data))
+
+    def write_eof(self):
+        # Fechamento só do sentido de envio: o FIN sai depois dos dados
+        # pendentes e a recepção continua
+        self.conexao.fechar()
+
+    def can_write_eof(self):
+        return True
+
+    def abort(self):
+        if self.perdido:
+            return
+        self.fechando = True
+        self.conexao.abortar()
+        self._perder(None)
+
+
+def servir(fabrica_protocolo, rede, porta, **kwargs):
+    """
+    Equivalente a loop.create_server: cria um Servidor (os demais argumentos
+    são repassados a ele) e associa cada conexão aceita a um protocolo
+    criado por fabrica_protocolo.
+    """
+    def conexao_aceita(conexao):
+        protocolo = fabrica_protocolo()
+        protocolo.connection_made(Transporte(conexao, protocolo))
+
+    servidor = Servidor(rede, porta, **kwargs)
+    servidor.registrar_monitor_de_conexoes_aceitas(conexao_aceita)
+    return servidor
+
+
+def iniciar_servidor(callback, rede, porta, limite=LIMITE_LEITOR, **kwargs):
+    """
+    Equivalente a asyncio.start_server: callback(reader, writer) é chamado
+    (e, se for uma corrotina, agendado como tarefa) para cada conexão aceita.
+    """
+    def fabrica_protocolo():
+        leitor = asyncio.StreamReader(limit=limite)
+        return asyncio.StreamReaderProtocol(leitor, callback)
+
+    return servir(fabrica_protocolo, rede, porta, **kwargs)
@@ -0,0 +1,254 @@
+"""
+Fragmentação e remontagem de datagramas IPv4 (RFC 791 e RFC 815).
+
+fragmentar divide um datagrama em pedaços que caibam no MTU de um enlace.
+Remontador junta os fragmentos recebidos de volta no datagrama original.
+Cada datagrama em remontagem ocupa um único buffer e uma lista de buracos
+(os trechos que ainda faltam), o que dispensa guardar os fragmentos
+separados e torna a remontagem independente da ordem de chegada. A memória
+total dos buffers tem um limite: quando ele seria ultrapassado, as
+remontagens mais antigas são abandonadas, como também acontece com as que
+passam do tempo limite sem se completar.
+"""
+
+import struct
+from collections import OrderedDict
+from checksum import calc_checksum
+from temporizador import relogio
+from metricas import registro
+
+# Bits do campo flags/fragment offset (vide RFC 791)
+FLAG_DF = 0x4000
+FLAG_MF = 0x2000
+MASCARA_OFFSET = 0x1fff
+
+# Menor MTU que todo enlace IPv4 deve suportar
+MTU_MINIMO = 68
+
+# Maior tamanho possível de um datagrama IPv4
+TAMANHO_MAXIMO_DATAGRAMA = 65535
+
+# Tempo máximo, em segundos, para que todos os fragmentos de um datagrama
+# cheguem (o mesmo padrão do Linux)
+TEMPO_REMONTAGEM = 30
+
+# Limite, em bytes, da memória ocupada pelos buffers de remontagem
+MEMORIA_REMONTAGEM = 4 * 1024 * 1024
+
+# Buffer alocado para uma remontagem cujo tamanho total ainda é desconhecido
+# (nenhum fragmento com MF desligado chegou); cresce por duplicação
+TAMANHO_INICIAL_REMONTAGEM = 2048
+
+
+def _opcoes_copiadas(opcoes):
+    """
+    Retorna as opções do cabeçalho que devem se repetir em todos os
+    fragmentos (as com o bit "copied" ligado), completadas até um múltiplo
+    de 4 bytes.
+    """
+    copiadas = bytearray()
+    i = 0
+    while i < len(opcoes):
+        tipo = opcoes[i]
+        if tipo == 0:       # fim da lista de opções
+            break
+        if tipo == 1:       # NOP
+            i += 1
+            continue
+        if i + 1 >= len(opcoes) or opcoes[i+1] < 2:
+            break
+        tamanho = opcoes[i+1]
+        if tipo & 0x80:
+            copiadas += opcoes[i:i+tamanho]
+        i += tamanho
+    copiadas += bytes(-len(copiadas) % 4)
+    return bytes(copiadas)
+
+
+def fragmentar(datagrama, mtu):
+    """
+    Divide o datagrama em fragmentos de no máximo mtu bytes, retornando a
+    lista deles (com o próprio datagrama, se já couber). Funciona também
+    com um datagrama que já é um fragmento, como acontece em um roteador.
+    Quem chama deve verificar antes o bit DF.
+    """
+    if len(datagrama) <= mtu:
+        return [datagrama]
+    ihl = (datagrama[0] & 0xf) * 4
+    total = int.from_bytes(datagrama[2:4], 'big')
+    flagsfrag = int.from_bytes(datagrama[6:8], 'big')
+    offset_original = flagsfrag & MASCARA_OFFSET
+    mf_original = flagsfrag & FLAG_MF
+    payload = memoryview(datagrama)[ihl:total]
+    cabecalho = bytes(datagrama[:ihl])
+    cabecalho_seguintes = cabecalho[:20] + _opcoes_copiadas(cabecalho[20:])
+
+    fragmentos = []
+    inicio = 0
+    while inicio < len(payload):
+        ihl_frag = len(cabecalho)
+        # Todo fragmento, exceto o último, leva um múltiplo de 8 bytes
+        tamanho = (mtu - ihl_frag) & ~7
+        if tamanho <= 0:
+            raise ValueError('MTU %d pequeno demais para um cabeçalho de %d bytes'
+                             % (mtu, ihl_frag))
+        fim = min(inicio + tamanho, len(payload))
+        mf = FLAG_MF if fim < len(payload) else mf_original
+        frag = bytearray(cabecalho)
+        frag += payload[inicio:fim]
+        frag[0] = 0x40 | (ihl_frag // 4)
+        struct.pack_into('!H', frag, 2, len(frag))
+        struct.pack_into('!H', frag, 6, (flagsfrag & FLAG_DF) | mf |
+                         (offset_original + inicio // 8))
+        frag[10:12] = b'\x00\x00'
+        struct.pack_into('!H', frag, 10, calc_checksum(frag[:ihl_frag]))
+        fragmentos.append(bytes(frag))
+        cabecalho = cabecalho_seguintes
+        inicio = fim
+    payload.release()
+    return fragmentos
+
+
+class _Remontagem:
+    __slots__ = ('buffer', 'buracos', 'tamanho', 'cabecalho', 'criacao')
+
+    def __init__(self, tamanho_buffer, criacao):
+        self.buffer = bytearray(tamanho_buffer)
+        # Trechos [inicio, fim) do payload ainda não recebidos; o fim do
+        # último é infinito até que chegue o fragmento final
+        self.buracos = [[0, TAMANHO_MAXIMO_DATAGRAMA]]
+        self.tamanho = None         # tamanho total do payload, quando conhecido
+        self.cabecalho = None       # cabeçalho do primeiro fragmento
+        self.criacao = criacao
+
+
+class Remontador:
+    def __init__(self, memoria_maxima=MEMORIA_REMONTAGEM, tempo_limite=TEMPO_REMONTAGEM):
+        self.memoria_maxima = memoria_maxima
+        self.tempo_limite = tempo_limite
+        # (origem, destino, identification, protocolo) -> _Remontagem, da
+        # mais antiga para a mais nova
+        self.remontagens = OrderedDict()
+        self.memoria = 0
+
+    def __len__(self):
+        return len(self.remontagens)
+
+    def _abandonar(self, chave, motivo):
+        remontagem = self.remontagens.pop(chave)
+        self.memoria -= len(remontagem.buffer)
+        registro.contadores['ip.remontagem.' + motivo] += 1
+
+    def _expirar(self, agora):
+        limite = agora - self.tempo_limite
+        while self.remontagens:
+            chave, remontagem = next(iter(self.remontagens.items()))
+            if remontagem.criacao > limite:
+                break
+            self._abandonar(chave, 'expiradas')
+
+    def _reservar(self, remontagem, tamanho):
+        """
+        Garante que o buffer da remontagem tenha ao menos tamanho bytes,
+        dentro do limite de memória. Retorna False se não houver espaço.
+        """
+        atual = len(remontagem.buffer)
+        if tamanho <= atual:
+            return True
+        if remontagem.tamanho is None:
+            tamanho = min(max(tamanho, 2 * atual), TAMANHO_MAXIMO_DATAGRAMA)
+        acrescimo = tamanho - atual
+        # Abandona as remontagens mais antigas até que o acréscimo caiba
+        while self.memoria + acrescimo > self.memoria_maxima:
+            chave = next(iter(self.remontagens))
+            if self.remontagens[chave] is remontagem:
+                return False
+            self._abandonar(chave, 'sem_memoria')
+        remontagem.buffer += bytes(acrescimo)
+        self.memoria += acrescimo
+        return True
+
+    def adicionar(self, fragmento):
+        """
+        Acrescenta um fragmento (um datagrama com MF ligado ou offset
+        diferente de zero). Retorna o datagrama remontado, com cabeçalho
+        válido e sem as flags de fragmentação, quando ele se completa, ou
+        None enquanto faltarem pedaços ou se o fragmento for inválido.
+        """
+        agora = relogio()
+        self._expirar(agora)
+        if len(fragmento) < 20:
+            registro.contadores['ip.remontagem.invalidos'] += 1
+            return None
+        ihl = (fragmento[0] & 0xf) * 4
+        total = int.from_bytes(fragmento[2:4], 'big')
+        flagsfrag = int.from_bytes(fragmento[6:8], 'big')
+        inicio = (flagsfrag & MASCARA_OFFSET) * 8
+        fim = inicio + total - ihl
+        mais = flagsfrag & FLAG_MF
+        # O comprimento total não pode ir além dos bytes que de fato chegaram
+        if ihl < 20 or total < ihl or len(fragmento) < total or \
+                fim > TAMANHO_MAXIMO_DATAGRAMA - ihl or (mais and (fim - inicio) % 8) or fim <= inicio:
+            registro.contadores['ip.remontagem.invalidos'] += 1
+            return None
+        chave = (bytes(fragmento[12:20]), int.from_bytes(fragmento[4:6], 'big'), fragmento[9])
+        remontagem = self.remontagens.get(chave)
+        if remontagem is None:
+            remontagem = _Remontagem(0, agora)
+            self.remontagens[chave] = remontagem
+            tamanho_buffer = fim if not mais else max(fim, TAMANHO_INICIAL_REMONTAGEM)
+            if not self._reservar(remontagem, tamanho_buffer):
+                self._abandonar(chave, 'sem_memoria')
+                return None
+
+        if not mais:
+            if remontagem.tamanho is not None and remontagem.tamanho != fim:
+                # Dois fragmentos finais discordantes
+                self._abandonar(chave, 'invalidos')
+                return None
+            remontagem.tamanho = fim
+        elif remontagem.tamanho is not None and fim > remontagem.tamanho:
+            self._abandonar(chave, 'invalidos')
+            return None
+        if not self._reservar(remontagem, fim):
+            self._abandonar(chave, 'sem_memoria')
+            return None
+        remontagem.buffer[inicio:fim] = fragmento[ihl:total]
+        if inicio == 0:
+            remontagem.cabecalho = bytes(fragmento[:ihl])
+
+        # Atualiza a lista de buracos (RFC 815)
+        buracos = []
+        for b_inicio, b_fim in remontagem.buracos:
+            if remontagem.tamanho is not None:
+                b_fim = min(b_fim, remontagem.tamanho)
+            if fim <= b_inicio or inicio >= b_fim:
+                if b_inicio < b_fim:
+                    buracos.append([b_inicio, b_fim])
+                continue
+            if b_inicio < inicio:
+                buracos.append([b_inicio, inicio])
+            if fim < b_fim:
+                buracos.append([fim, b_fim])
+        remontagem.buracos = buracos
+        if buracos:
+            return None
+
+        self._abandonar(chave, 'completas')
+        tamanho = remontagem.tamanho
+        cabecalho = remontagem.cabecalho
+        ihl = len(cabecalho)
+        datagrama = bytearray(cabecalho)
+        datagrama += memoryview(remontagem.buffer)[:tamanho]
+        struct.pack_into('!H', datagrama, 2, ihl + tamanho)
+        struct.pack_into('!H', datagrama, 6, int.from_bytes(cabecalho[6:8], 'big') & FLAG_DF)
+        datagrama[10:12] = b'\x00\x00'
+        struct.pack_into('!H', datagrama, 10, calc_checksum(datagrama[:ihl]))
+        return bytes(datagrama)
+
+    def estatisticas(self):
+        return {
+            'remontagens': len(self.remontagens),
+            'memoria': self.memoria,
+            'memoria_maxima': self.memoria_maxima,
+        }
@@ -1,108 +1,188 @@
+from collections import OrderedDict
 from iputils import *
+from checksum import calc_checksum
+from metricas import registro
+from fragmentacao import fragmentar, Remontador, FLAG_DF, MEMORIA_REMONTAGEM, TEMPO_REMONTAGEM
 
-tabela_encaminhamento = []
 
 class IP:
-    def __init__(self, enlace):
+    def __init__(self, enlace, tamanho_cache_rotas=256,
+                 memoria_remontagem=MEMORIA_REMONTAGEM, tempo_remontagem=TEMPO_REMONTAGEM):
         """
         Inicia a camada de rede. Recebe como argumento uma implementação
         de camada de enlace capaz de localizar os next_hop (por exemplo,
         Ethernet com ARP).
+
+        O argumento tamanho_cache_rotas limita quantos destinos recentes têm
+        o seu next_hop guardado em cache (0 desativa o cache).
+
+        Os argumentos memoria_remontagem e tempo_remontagem limitam a memória
+        (em bytes) e o tempo (em segundos) dedicados a remontar datagramas
+        fragmentados (vide fragmentacao.Remontador).
         """
         self.callback = None
         self.enlace = enlace
         self.enlace.registrar_recebedor(self.__raw_recv)
         self.ignore_checksum = self.enlace.ignore_checksum
         self.meu_endereco = None
+        self.meu_endereco_bin = None
         self.protocolo = IPPROTO_TCP
-
+        self.tabela_encaminhamento = ()
+        self.tamanho_cache_rotas = tamanho_cache_rotas
+        self.cache_rotas = OrderedDict()
+        self.cache_acertos = 0
+        self.cache_falhas = 0
+        self.captura = None
+        # Se a camada de enlace não tiver o método mtu, o tamanho dos enlaces
+        # é desconhecido e nada é fragmentado no envio
+        self.mtu_enlace = getattr(enlace, 'mtu', None)
+        self.identification = 0
+        self.remontador = Remontador(memoria_remontagem, tempo_remontagem)
+
+    def capturar(self, captura):
+        """
+        Passa a registrar na captura dada (um objeto da classe Captura, vide
+        captura.py) todos os datagramas recebidos, sejam para este host ou a
+        encaminhar, e os enviados por ele. Use None para parar.
+        """
+        self.captura = captura
 
     def __raw_recv(self, datagrama):
+        registro.contadores['ip.datagramas_recebidos'] += 1
+        if not cabecalho_valido(datagrama):
+            registro.contadores['ip.descartes.malformados'] += 1
+            return
+        if self.captura is not None:
+            self.captura(datagrama)
+        if datagrama[16:20] != self.meu_endereco_bin:
+            # atua como roteador, sem remontar o cabeçalho
+            self._encaminhar(datagrama)
+            return
+        # atua como host
+        if datagrama[6] & 0x3f or datagrama[7]:
+            # MF ligado ou offset diferente de zero: é um fragmento
+            datagrama = self.remontador.adicionar(datagrama)
+            if datagrama is None:
+                return
+            registro.contadores['ip.datagramas_remontados'] += 1
         dscp, ecn, identification, flags, frag_offset, ttl, proto, \
            src_addr, dst_addr, payload = read_ipv4_header(datagrama)
-        if dst_addr == self.meu_endereco:
-            # atua como host
-            if proto == IPPROTO_TCP and self.callback:
-                self.callback(src_addr, dst_addr, payload)
+        if proto == IPPROTO_TCP and self.callback:
+            self.callback(src_addr, dst_addr, payload)
         else:
-            # atua como roteador
-            # prepara o encaminhamento dos pacotes para o proximo hop
-            next_hop = self._next_hop(dst_addr)
-            ttl -= 1
-
-            # caso o pacote possa ser enviado para outro hop
-
-            if ttl > 0:
-                encaminha_datagrama = make_ipv4_header(payload, src_addr, dst_addr, self.protocolo, ttl) + payload
-                self.enlace.enviar(encaminha_datagrama, next_hop)
-
-            else:   # TTL <= 0
-                    #Encaminha um datagrama com o erro ICMP (Internet Control Message Protocol)
-                segmento = datagrama[:28]
-                # Type = 11 (8 bits) | Code = 0 (8 bits) | Checksum (16 bits)
-
-                icmp_type = 11
-                icmp_code = 0
-                icmp_unused = 0
+            registro.contadores['ip.descartes.protocolo'] += 1
 
-                payload = struct.pack('!BBHI', icmp_type,  icmp_code, 0, icmp_unused) + segmento
-                icmp_checksum = calc_checksum(payload)
-                payload = struct.pack('!BBHI', icmp_type,  icmp_code, icmp_checksum, icmp_unused) + segmento
+    def _encaminhar(self, datagrama):
+        """
+        Caminho rápido de encaminhamento: decrementa o TTL no próprio buffer e
+        corrige o checksum de forma incremental (RFC 1624), preservando os
+        demais campos do cabeçalho (DSCP/ECN, identification, flags, opções).
+        """
+        ttl = datagrama[8]
+        if ttl <= 1:
+            registro.contadores['ip.descartes.ttl_expirado'] += 1
+            self._enviar_icmp_tempo_excedido(datagrama)
+            return
+        next_hop = self._next_hop_int(int.from_bytes(datagrama[16:20], 'big'))
+        if next_hop is None:
+            registro.contadores['ip.descartes.sem_rota'] += 1
+            return
+        if datagrama[6] & (FLAG_DF >> 8) and self.mtu_enlace is not None:
+            mtu = self.mtu_enlace(next_hop)
+            if len(datagrama) > mtu:
+                # Type = 3 (Destination Unreachable), Code = 4 (Fragmentation Needed)
+                registro.contadores['ip.descartes.fragmentacao_proibida'] += 1
+                self._enviar_icmp(datagrama, 3, 4, mtu)
+                return
+        registro.contadores['ip.datagramas_encaminhados'] += 1
+        buf = bytearray(datagrama)
+        buf[8] = ttl - 1
+        # HC' = ~(~HC + ~m + m'), onde m é a palavra de 16 bits TTL|protocolo.
+        # Como m' = m - 0x100, ~m + m' = 0xfeff em complemento de um.
+        soma = (~((buf[10] << 8) | buf[11]) & 0xffff) + 0xfeff
+        soma = (soma & 0xffff) + (soma >> 16)
+        checksum = ~soma & 0xffff
+        buf[10] = checksum >> 8
+        buf[11] = checksum & 0xff
+        self._enviar_enlace(buf, next_hop)
+
+    def _enviar_enlace(self, datagrama, next_hop):
+        """
+        Entrega o datagrama à camada de enlace, fragmentando-o se ele não
+        couber no MTU do enlace que leva a next_hop.
+        """
+        if self.mtu_enlace is not None:
+            mtu = self.mtu_enlace(next_hop)
+            if len(datagrama) > mtu:
+                fragmentos = fragmentar(datagrama, mtu)
+                registro.contadores['ip.datagramas_fragmentados'] += 1
+                registro.contadores['ip.fragmentos_enviados'] += len(fragmentos)
+                for fragmento in fragmentos:
+                    self.enlace.enviar(fragmento, next_hop)
+                return
+        self.enlace.enviar(datagrama, next_hop)
 
-                self.protocolo = IPPROTO_ICMP
-                encaminha_datagrama = make_ipv4_header(payload, self.meu_endereco, src_addr, self.protocolo) + payload
-                self.enlace.enviar(encaminha_datagrama, self._next_hop(src_addr))
-                self.protocolo = IPPROTO_TCP
+    def _enviar_icmp_tempo_excedido(self, datagrama):
+        # Type = 11 (Time Exceeded), Code = 0 (TTL expirado em trânsito)
+        self._enviar_icmp(datagrama, 11, 0)
+
+    def _enviar_icmp(self, datagrama, icmp_type, icmp_code, icmp_unused=0):
+        # Encaminha um datagrama com o erro ICMP (Internet Control Message Protocol)
+        # de volta à origem, citando o cabeçalho e o início do datagrama original.
+        # No Destination Unreachable com Code = 4 (Fragmentation Needed), o campo
+        # icmp_unused leva, nos 16 bits de baixo, o MTU do próximo enlace.
+        src_addr = addr2str(datagrama[12:16])
+        segmento = datagrama[:28]
+        # Type (8 bits) | Code (8 bits) | Checksum (16 bits)
+
+        payload = struct.pack('!BBHI', icmp_type,  icmp_code, 0, icmp_unused) + segmento
+        icmp_checksum = calc_checksum(payload)
+        payload = struct.pack('!BBHI', icmp_type,  icmp_code, icmp_checksum, icmp_unused) + segmento
+
+        encaminha_datagrama = make_ipv4_header(payload, self.meu_endereco, src_addr, IPPROTO_ICMP) + payload
+        next_hop = self._next_hop(src_addr)
+        if next_hop is None:
+            registro.contadores['ip.descartes.sem_rota'] += 1
+            return
+        registro.contadores['ip.icmp_enviados'] += 1
+        if self.captura is not None:
+            self.captura(encaminha_datagrama)
+        self._enviar_enlace(encaminha_datagrama, next_hop)
 
 
     def _next_hop(self, dest_addr):
-        # TODO: Use a tabela de encaminhamento para determinar o próximo salto
-        # (next_hop) a partir do endereço de destino do datagrama (dest_addr).
-        # Retorne o next_hop para o dest_addr fornecido.
-
-        #print('IP DESTINO: ')
-        #print(dest_addr)
-        #print('***************')
-
-        global tabela_encaminhamento
-
-        if not tabela_encaminhamento:
-            return None  # retorna vazio se a tabela de encaminhamento estiver vazia
-
-        lista_possivel_proximo = []
-
-        for item in tabela_encaminhamento:
-            # procura os possiveis enderecos destino
-            # se um IP conhecido da tabela de encaminhamento for igual ao endereço destino
-            (possivel_proximo, prefixo) = item[0].split("/") # possivel_proximo = IP sem o prefixo
-            #print('IP Tabela Encaminhamento: ')
-            #print(item)
-            #print('*******************')
-            # se o IP conhecido não for igual ao endereço destino, encontrar um endereco mais proximo
-
-            possivel_proximo_split = possivel_proximo.split(".") #divide a string IP em cada ponto (x.y.z.w)
-            ip_binario = ""
-            for i in possivel_proximo_split:
-                ip_binario += "{0:08b}".format(int(i)) # para cada item, converte em um binario de 8 digitos e concatena em uma string
-
-            dest_addr_split = dest_addr.split(".")
-            dest_addr_binario = ""
-            for i in dest_addr_split:
-                dest_addr_binario += "{0:08b}".format(int(i)) # converte o endereco destino em binario
-
-
-            if dest_addr_binario[:int(prefixo)] == ip_binario[:int(prefixo)]: # se o começo do ip destino tiver identicamente os mesmos bits do IP conhecido
-                lista_possivel_proximo.append((item[1], int(prefixo))) # adiciona o IP conhecido a lista de possivel proximo e qual o prefixo da tabela
-
-        if not lista_possivel_proximo:
-            return None
-
-        ordena_lista_possivel_proximo = sorted(lista_possivel_proximo, key=lambda tup: tup[1], reverse = True) # ordena a lista de possiveis proximos pelo maior prefixo
-        ip_next_hop = ordena_lista_possivel_proximo[0]
-        #print('Lista possiveis proximos: ')
-        #print(ordena_lista_possivel_proximo)
-        #print('**********************')
-        return ip_next_hop[0]
+        """
+        Retorna o next_hop para o dest_addr fornecido (string no formato
+        x.y.z.w), ou None se nenhuma rota da tabela de encaminhamento casar.
+        """
+        return self._next_hop_int(addr2int(dest_addr))
+
+    def _next_hop_int(self, dest):
+        cache = self.cache_rotas
+        try:
+            next_hop = cache[dest]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(dest)
+            self.cache_acertos += 1
+            return next_hop
+        self.cache_falhas += 1
+        next_hop = self._consultar_tabela(dest)
+        if self.tamanho_cache_rotas > 0:
+            cache[dest] = next_hop
+            if len(cache) > self.tamanho_cache_rotas:
+                cache.popitem(last=False)   # descarta o usado há mais tempo
+        return next_hop
+
+    def _consultar_tabela(self, dest):
+        # Percorre os comprimentos de prefixo do maior para o menor; o primeiro
+        # que casar é o prefixo mais longo. Não há trabalho com strings aqui.
+        for mascara, redes in self.tabela_encaminhamento:
+            next_hop = redes.get(dest & mascara)
+            if next_hop is not None:
+                return next_hop
+        return None
 
 
     def definir_endereco_host(self, meu_endereco):
@@ -112,6 +192,8 @@ class IP:
         atuaremos como roteador em vez de atuar como host.
         """
         self.meu_endereco = meu_endereco
+        self.meu_endereco_bin = str2addr(meu_endereco)
+        registro.registrar_fonte('ip.%s.cache_rotas' % meu_endereco, self.estatisticas_cache_rotas)
 
     def definir_tabela_encaminhamento(self, tabela):
         """
@@ -121,16 +203,23 @@ class IP:
         Onde os CIDR são fornecidos no formato 'x.y.z.w/n', e os
         next_hop são fornecidos no formato 'x.y.z.w'.
         """
-        # TODO: Guarde a tabela de encaminhamento. Se julgar conveniente,
-        # converta-a em uma estrutura de dados mais eficiente.
+        # A tabela é compilada por inteiro antes de ser publicada, de modo
+        # que a troca seja atômica: uma consulta em andamento nunca enxerga
+        # uma tabela pela metade. O cache de rotas deixa de valer junto.
+        self.tabela_encaminhamento = compilar_tabela(tabela)
+        self.cache_rotas = OrderedDict()
 
-        global tabela_encaminhamento
-        tabela_encaminhamento = []
-
-        for item in tabela:
-            ip_local = item[0]
-            ip_proximo = item[1]
-            tabela_encaminhamento.append((ip_local, ip_proximo))
+    def estatisticas_cache_rotas(self):
+        """
+        Retorna um dicionário com o tamanho atual, a capacidade e os
+        contadores de acertos e falhas do cache de rotas.
+        """
+        return {
+            'tamanho': len(self.cache_rotas),
+            'capacidade': self.tamanho_cache_rotas,
+            'acertos': self.cache_acertos,
+            'falhas': self.cache_falhas,
+        }
 
     def registrar_recebedor(self, callback):
         """
@@ -144,13 +233,20 @@ class IP:
         (string no formato x.y.z.w).
         """
         next_hop = self._next_hop(dest_addr)
+        if next_hop is None:
+            registro.contadores['ip.descartes.sem_rota'] += 1
+            return
+        registro.contadores['ip.datagramas_enviados'] += 1
         # TODO: Assumindo que a camada superior é o protocolo TCP, monte o
         # datagrama com o cabeçalho IP, contendo como payload o segmento.
-        datagrama = make_ipv4_header(segmento, self.meu_endereco, dest_addr, self.protocolo) + segmento
-
-        self.enlace.enviar(datagrama, next_hop)
-
-def make_ipv4_header(segmento, src_addr, dest_addr, protocolo, ttl=64):
+        self.identification = (self.identification + 1) & 0xffff
+        datagrama = make_ipv4_header(segmento, self.meu_endereco, dest_addr, self.protocolo,
+                                     identification=self.identification) + segmento
+        if self.captura is not None:
+            self.captura(datagrama)
+        self._enviar_enlace(datagrama, next_hop)
+
+def make_ipv4_header(segmento, src_addr, dest_addr, protocolo, ttl=64, identification=0, flagsfrag=0):
     version = 4 << 4
     ihl = 5
     vihl = version | ihl
@@ -158,15 +254,52 @@ def make_ipv4_header(segmento, src_addr, dest_addr, protocolo, ttl=64):
     ecn = 0
     dscpecn = dscp | ecn
     total_len = len(segmento) + 20
-    identification = 0
-    flagsfrag = 0
     ttl = ttl
     proto = protocolo
     s = int.from_bytes(str2addr(src_addr), "big")
     d = int.from_bytes(str2addr(dest_addr), "big")
-    header = struct.pack('!BBHHHBBHII', vihl, dscpecn, total_len,
-        identification, flagsfrag, ttl, proto, 0, s, d)
-    checksum = calc_checksum(header)
-    novo_header = struct.pack('!BBHHHBBHII', vihl, dscpecn, total_len, identification,
-                    flagsfrag, ttl, proto, checksum, s, d)
-    return novo_header
+    header = bytearray(struct.pack('!BBHHHBBHII', vihl, dscpecn, total_len,
+        identification, flagsfrag, ttl, proto, 0, s, d))
+    struct.pack_into('!H', header, 10, calc_checksum(header))
+    return bytes(header)
+
+
+def cabecalho_valido(datagrama):
+    """
+    Confere se o datagrama é IPv4 e se o IHL, o comprimento total e a
+    quantidade de bytes recebidos são coerentes entre si (um datagrama
+    truncado, por exemplo, não é).
+    """
+    if len(datagrama) < 20 or datagrama[0] >> 4 != 4:
+        return False
+    ihl = (datagrama[0] & 0xf) * 4
+    total = (datagrama[2] << 8) | datagrama[3]
+    return 20 <= ihl <= total <= len(datagrama)
+
+
+def addr2int(addr):
+    """
+    Converte uma string (no formato x.y.z.w) para um endereço IPv4 inteiro
+    """
+    a, b, c, d = addr.split('.')
+    return (int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d)
+
+
+def compilar_tabela(tabela):
+    """
+    Converte uma tabela de encaminhamento [(cidr, next_hop), ...] em uma
+    tupla ((mascara, {rede: next_hop}), ...) ordenada do maior para o menor
+    comprimento de prefixo, com endereços representados como inteiros.
+
+    Com isso, o casamento do prefixo mais longo custa no máximo uma consulta
+    a dicionário por comprimento de prefixo distinto presente na tabela.
+    """
+    por_prefixo = {}
+    for cidr, next_hop in tabela:
+        endereco, n = cidr.split('/')
+        n = int(n)
+        mascara = (0xffffffff << (32 - n)) & 0xffffffff
+        # Em caso de rotas repetidas, vale a primeira, como na tabela original
+        por_prefixo.setdefault(n, {}).setdefault(addr2int(endereco) & mascara, next_hop)
+    return tuple(((0xffffffff << (32 - n)) & 0xffffffff, por_prefixo[n])
+                 for n in sorted(por_prefixo, reverse=True))
@@ -0,0 +1,151 @@
+"""
+Instrumentação compartilhada pelas camadas da pilha.
+
+Cada camada incrementa contadores no registro global (quadros, datagramas,
+segmentos, bytes, descartes por motivo, retransmissões...), com nomes no
+formato 'camada.nome'. Incrementar um contador custa uma operação de
+dicionário, o mesmo que custaria testar se a instrumentação está ligada, por
+isso os contadores estão sempre ativos.
+
+Mensagens de rastreamento, que custam formatar texto, só são geradas se o
+nível delas for ao menos o nível configurado, que por padrão as desliga. O
+teste fica no chamador, para que nem os argumentos sejam avaliados:
+
+    if registro.nivel <= DEPURACAO:
+        registro.rastrear(DEPURACAO, 'tcp', 'recebido payload: %r', payload)
+
+O método instantaneo retorna uma cópia de todos os valores, pronta para ser
+exportada periodicamente (por exemplo, como JSON).
+"""
+
+import sys
+import time
+import traceback
+from bisect import bisect_left
+from collections import defaultdict
+
+# Níveis de rastreamento (os mesmos valores do módulo logging)
+DEPURACAO = 10
+INFORMACAO = 20
+AVISO = 30
+DESLIGADO = sys.maxsize
+
+# Limites superiores (em segundos) das faixas do histograma de RTT
+LIMITES_RTT = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+
+class Histograma:
+    """
+    Conta observações em faixas de valores. A faixa i guarda os valores até
+    limites[i] (inclusive); a última, os maiores que todos os limites.
+    """
+    __slots__ = ('limites', 'faixas', 'contagem', 'soma', 'minimo', 'maximo')
+
+    def __init__(self, limites=LIMITES_RTT):
+        self.limites = limites
+        self.faixas = [0] * (len(limites) + 1)
+        self.contagem = 0
+        self.soma = 0.
+        self.minimo = None
+        self.maximo = None
+
+    def observar(self, valor):
+        self.faixas[bisect_left(self.limites, valor)] += 1
+        self.contagem += 1
+        self.soma += valor
+        if self.minimo is None or valor < self.minimo:
+            self.minimo = valor
+        if self.maximo is None or valor > self.maximo:
+            self.maximo = valor
+
+    def instantaneo(self):
+        return {
+            'limites': list(self.limites),
+            'faixas': list(self.faixas),
+            'contagem': self.contagem,
+            'soma': self.soma,
+            'minimo': self.minimo,
+            'maximo': self.maximo,
+        }
+
+
+class Registro:
+    def __init__(self):
+        self.contadores = defaultdict(int)
+        self.histogramas = {}
+        self.fontes = {}
+        self.nivel = DESLIGADO
+        self.rastreador = None
+
+    def contar(self, nome, n=1):
+        self.contadores[nome] += n
+
+    def histograma(self, nome, limites=LIMITES_RTT):
+        """
+        Retorna o histograma com o nome dado, criando-o na primeira vez.
+        """
+        histograma = self.histogramas.get(nome)
+        if histograma is None:
+            histograma = self.histogramas[nome] = Histograma(limites)
+        return histograma
+
+    def registrar_fonte(self, nome, callback):
+        """
+        Registra uma função que retorna um dicionário com estatísticas
+        próprias (por exemplo, de cada conexão) a incluir nos instantâneos.
+        """
+        self.fontes[nome] = callback
+
+    def remover_fonte(self, nome):
+        self.fontes.pop(nome, None)
+
+    def ligar_rastreamento(self, nivel=DEPURACAO, rastreador=None):
+        """
+        Passa a gerar mensagens de rastreamento a partir do nível dado. O
+        rastreador é chamado como rastreador(nivel, camada, mensagem); se não
+        for fornecido, as mensagens são escritas na saída de erros.
+        """
+        self.nivel = nivel
+        self.rastreador = rastreador
+
+    def desligar_rastreamento(self):
+        self.nivel = DESLIGADO
+
+    def rastrear(self, nivel, camada, mensagem, *args):
+        if nivel < self.nivel:
+            return
+        if args:
+            mensagem = mensagem % args
+        if self.rastreador:
+            try:
+                self.rastreador(nivel, camada, mensagem)
+            except:
+                traceback.print_exc()
+        else:
+            print('[%s] %s' % (camada, mensagem), file=sys.stderr)
+
+    def instantaneo(self):
+        """
+        Retorna um dicionário com o instante atual e cópias dos contadores,
+        dos histogramas e das estatísticas de cada fonte registrada.
+        """
+        fontes = {}
+        for nome, callback in list(self.fontes.items()):
+            try:
+                fontes[nome] = callback()
+            except:
+                traceback.print_exc()
+        return {
+            'instante': time.time(),
+            'contadores': dict(self.contadores),
+            'histogramas': {nome: h.instantaneo() for nome, h in self.histogramas.items()},
+            'fontes': fontes,
+        }
+
+    def zerar(self):
+        self.contadores.clear()
+        self.histogramas.clear()
+
+
+# Registro compartilhado por todas as camadas
+registro = Registro()
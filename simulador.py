@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Simulador de redes de placas em tempo virtual.
+
+Várias pilhas (IP, CamadaEnlace e, opcionalmente, Servidor) são criadas no
+mesmo processo e ligadas por linhas seriais simuladas (vide
+camadafisica.LinhaVirtual). Tudo roda em um LacoVirtual, um laço de eventos
+do asyncio cujo relógio salta direto para o próximo temporizador em vez de
+esperar: horas de tráfego e de temporizadores do TCP passam em segundos, e
+uma simulação com a mesma semente se repete exatamente.
+
+A topologia é descrita por um dicionário {nome: placa}, em que cada placa é
+um dicionário com 'endereco', 'tabela' (no formato de
+IP.definir_tabela_encaminhamento), 'vizinhos' (os endereços das outras pontas
+dos enlaces) e, opcionalmente, 'opcoes_enlaces' (vide CamadaEnlace). Duas
+placas que se listam como vizinhas são ligadas por uma linha. A função
+topologia_das_placas extrai essa descrição dos scripts placa1.py, placa2.py
+e placa3.py, sem executá-los.
+
+Exemplo:
+    sim = Simulacao(topologia_das_placas(), baud=115200)
+    servidor = sim.servidor('placa3', 7000)
+    cliente = sim.servidor('placa1', 40000)
+    sim.executar(alguma_corrotina(cliente, servidor))
+"""
+
+import os
+import ast
+import time
+import random
+import asyncio
+import selectors
+from camadafisica import LinhaVirtual, par_de_linhas
+from ip import IP
+from slip import CamadaEnlace
+from tcp import Servidor
+
+
+class _SeletorVirtual(selectors.BaseSelector):
+    """
+    Repassa tudo a um seletor de verdade, mas nunca bloqueia: em vez de
+    esperar timeout segundos, avança o relógio do laço.
+    """
+
+    def __init__(self, laco, seletor):
+        self.laco = laco
+        self.seletor = seletor
+
+    def register(self, fileobj, events, data=None):
+        return self.seletor.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self.seletor.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self.seletor.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        eventos = self.seletor.select(0)
+        if not eventos:
+            if timeout is None:
+                raise RuntimeError('simulação parada: nada agendado no laço de eventos')
+            self.laco._avancar(timeout)
+        return eventos
+
+    def close(self):
+        self.seletor.close()
+
+    def get_map(self):
+        return self.seletor.get_map()
+
+
+class LacoVirtual(asyncio.SelectorEventLoop):
+    """
+    Laço de eventos com relógio virtual, que começa em zero e só anda quando
+    não há mais nada pronto para executar.
+    """
+
+    def __init__(self):
+        self._agora = 0.
+        super().__init__(_SeletorVirtual(self, selectors.DefaultSelector()))
+
+    def time(self):
+        return self._agora
+
+    def _avancar(self, segundos):
+        self._agora += segundos
+
+
+def ler_placa(caminho):
+    """
+    Extrai de um script como placa1.py, sem executá-lo, o endereço do host,
+    a tabela de encaminhamento e os vizinhos (as chaves do dicionário passado
+    a CamadaEnlace). Nomes de variáveis atribuídas a constantes no próprio
+    script são resolvidos.
+    """
+    with open(caminho) as f:
+        arvore = ast.parse(f.read(), caminho)
+    nomes = {}
+
+    def valor(no):
+        if isinstance(no, ast.Name):
+            if no.id not in nomes:
+                raise ValueError('%s: nome %s não é uma constante' % (caminho, no.id))
+            return nomes[no.id]
+        if isinstance(no, (ast.Tuple, ast.List)):
+            return [valor(elem) for elem in no.elts]
+        return ast.literal_eval(no)
+
+    for no in arvore.body:
+        if isinstance(no, ast.Assign) and len(no.targets) == 1 and \
+                isinstance(no.targets[0], ast.Name):
+            try:
+                nomes[no.targets[0].id] = valor(no.value)
+            except ValueError:
+                pass
+
+    placa = {}
+    for no in ast.walk(arvore):
+        if not isinstance(no, ast.Call) or not no.args:
+            continue
+        funcao = no.func.attr if isinstance(no.func, ast.Attribute) else \
+            getattr(no.func, 'id', None)
+        if funcao == 'definir_endereco_host':
+            placa['endereco'] = valor(no.args[0])
+        elif funcao == 'definir_tabela_encaminhamento':
+            placa['tabela'] = [tuple(rota) for rota in valor(no.args[0])]
+        elif funcao == 'CamadaEnlace' and isinstance(no.args[0], ast.Dict):
+            placa['vizinhos'] = [valor(chave) for chave in no.args[0].keys]
+    return placa
+
+
+def topologia_das_placas(diretorio=None):
+    """
+    Topologia descrita pelos scripts placa1.py, placa2.py e placa3.py
+    """
+    diretorio = diretorio or os.path.dirname(os.path.abspath(__file__))
+    return {nome: ler_placa(os.path.join(diretorio, nome + '.py'))
+            for nome in ('placa1', 'placa2', 'placa3')}
+
+
+class Simulacao:
+    def __init__(self, topologia, semente=1, **opcoes_linha):
+        """
+        Cria as pilhas descritas pela topologia em um novo LacoVirtual. As
+        opcoes_linha (baud, latencia, tamanho_pedaco, perda, corrupcao) valem
+        para todas as linhas; cada linha, assim como cada Servidor criado pelo
+        método servidor, recebe uma semente derivada da dada.
+        Vizinhos que não estão na topologia (como o PC ligado à placa1) ficam
+        em linhas sem nada na outra ponta.
+        """
+        self.laco = LacoVirtual()
+        asyncio.set_event_loop(self.laco)
+        self.topologia = topologia
+        self.semente = semente
+        self.servidores = []
+        self.redes = {}
+        self.linhas = {}        # (nome, endereço do vizinho) -> LinhaVirtual
+        self.enderecos = {placa['endereco']: nome for nome, placa in topologia.items()}
+        for nome, placa in topologia.items():
+            linhas_seriais = {}
+            for vizinho in placa['vizinhos']:
+                if (nome, vizinho) not in self.linhas:
+                    outro = self.enderecos.get(vizinho)
+                    if outro is not None and placa['endereco'] in topologia[outro]['vizinhos']:
+                        a, b = par_de_linhas(semente=semente, **opcoes_linha)
+                        semente += 2
+                        self.linhas[(nome, vizinho)] = a
+                        self.linhas[(outro, placa['endereco'])] = b
+                    else:
+                        self.linhas[(nome, vizinho)] = LinhaVirtual(**opcoes_linha)
+                linhas_seriais[vizinho] = self.linhas[(nome, vizinho)]
+            rede = IP(CamadaEnlace(linhas_seriais, placa.get('opcoes_enlaces')))
+            rede.definir_endereco_host(placa['endereco'])
+            rede.definir_tabela_encaminhamento(placa['tabela'])
+            self.redes[nome] = rede
+
+    @property
+    def agora(self):
+        return self.laco.time()
+
+    def endereco(self, nome):
+        return self.topologia[nome]['endereco']
+
+    def servidor(self, nome, porta, **kwargs):
+        """
+        Cria um Servidor TCP na placa dada (os demais argumentos são
+        repassados a ele). Os números de sequência iniciais e o segredo dos
+        SYN cookies dele são sorteados a partir da semente da simulação.
+        """
+        kwargs.setdefault('aleatorio', random.Random('%s:%s:%d' % (self.semente, nome, porta)))
+        servidor = Servidor(self.redes[nome], porta, **kwargs)
+        self.servidores.append(servidor)
+        return servidor
+
+    def linhas_entre(self, nome_a, nome_b):
+        """
+        Retorna as duas pontas (a de nome_a e a de nome_b) da linha que liga
+        as placas, para que as opções dela possam ser alteradas.
+        """
+        return (self.linhas[(nome_a, self.endereco(nome_b))],
+                self.linhas[(nome_b, self.endereco(nome_a))])
+
+    def romper(self, nome_a, nome_b):
+        """
+        Simula um cabo rompido: nada mais passa pela linha entre as placas.
+        """
+        for linha in self.linhas_entre(nome_a, nome_b):
+            linha.perda_original = linha.perda
+            linha.perda = 1.
+
+    def restaurar(self, nome_a, nome_b):
+        for linha in self.linhas_entre(nome_a, nome_b):
+            linha.perda = getattr(linha, 'perda_original', 0.)
+
+    def executar(self, corrotina):
+        """
+        Executa a corrotina até o fim, em tempo virtual, e retorna o resultado
+        """
+        return self.laco.run_until_complete(corrotina)
+
+    def avancar(self, segundos):
+        """
+        Deixa a simulação correr por segundos de tempo virtual
+        """
+        self.laco.run_until_complete(asyncio.sleep(segundos))
+
+    def fechar(self):
+        for servidor in self.servidores:
+            servidor.fechar()
+        self.laco.close()
+        asyncio.set_event_loop(None)
+
+
+async def _demonstracao(sim, total):
+    # Servidor de eco na placa3, como em placa3.py, e um cliente na placa1
+    def dados_recebidos(conexao, dados):
+        if dados == b'':
+            conexao.fechar()
+        else:
+            conexao.enviar(dados)
+
+    eco = sim.servidor('placa3', 7000)
+    eco.registrar_monitor_de_conexoes_aceitas(lambda c: c.registrar_recebedor(dados_recebidos))
+    cliente = sim.servidor('placa1', 40000)
+    recebidos = 0
+    fim = asyncio.get_event_loop().create_future()
+
+    def recebedor(conexao, dados):
+        nonlocal recebidos
+        recebidos += len(dados)
+        if recebidos >= total and not fim.done():
+            fim.set_result(None)
+
+    conexao = cliente.conectar(sim.endereco('placa3'), 7000)
+    conexao.registrar_recebedor(recebedor)
+    conexao.enviar(bytes(total))
+    # O cabo entre a placa2 e a placa3 fica rompido por um minuto
+    await asyncio.sleep(5)
+    sim.romper('placa2', 'placa3')
+    print('%8.2f s: cabo rompido com %d bytes ecoados' % (sim.agora, recebidos))
+    await asyncio.sleep(60)
+    sim.restaurar('placa2', 'placa3')
+    print('%8.2f s: cabo restaurado' % sim.agora)
+    await fim
+    print('%8.2f s: %d bytes ecoados' % (sim.agora, recebidos))
+
+
+if __name__ == '__main__':
+    inicio = time.perf_counter()
+    sim = Simulacao(topologia_das_placas(), baud=115200, latencia=0.001)
+    sim.executar(_demonstracao(sim, 200 * 1024))
+    print('tempo virtual: %.2f s, tempo real: %.2f s' % (sim.agora, time.perf_counter() - inicio))
+    sim.fechar()
@@ -1,7 +1,13 @@
+import asyncio
+from cslip import Compressor, Descompressor, SLOTS
+from metricas import registro
+from fragmentacao import MTU_MINIMO
+
+
 class CamadaEnlace:
     ignore_checksum = False
 
-    def __init__(self, linhas_seriais):
+    def __init__(self, linhas_seriais, opcoes_enlaces=None):
         """
         Inicia uma camada de enlace com um ou mais enlaces, cada um conectado
         a uma linha serial distinta. O argumento linhas_seriais é um dicionário
@@ -10,12 +16,21 @@ class CamadaEnlace:
         uma string no formato 'x.y.z.w'. A linha_serial é um objeto da classe
         PTY (vide camadafisica.py) ou de outra classe que implemente os métodos
         registrar_recebedor e enviar.
+
+        O argumento opcoes_enlaces, opcional, é um dicionário no formato
+        {ip_outra_ponta: {opcao: valor}} com argumentos adicionais para o
+        Enlace correspondente, por exemplo {'192.168.200.3': {'cslip': True}}
+        para ativar a compressão de cabeçalhos naquele enlace. As duas pontas
+        de um enlace devem ser configuradas da mesma forma. A opção 'mtu'
+        define o maior datagrama que o enlace transmite; datagramas maiores
+        são fragmentados pela camada IP (vide o método mtu).
         """
         self.enlaces = {}
         self.callback = None
+        opcoes_enlaces = opcoes_enlaces or {}
         # Constrói um Enlace para cada linha serial
         for ip_outra_ponta, linha_serial in linhas_seriais.items():
-            enlace = Enlace(linha_serial)
+            enlace = Enlace(linha_serial, **opcoes_enlaces.get(ip_outra_ponta, {}))
             self.enlaces[ip_outra_ponta] = enlace
             enlace.registrar_recebedor(self._callback)
 
@@ -25,6 +40,24 @@ class CamadaEnlace:
         """
         self.callback = callback
 
+    def mtu(self, next_hop):
+        """
+        Retorna o MTU do enlace que leva a next_hop
+        """
+        return self.enlaces[next_hop].mtu
+
+    def capturar(self, captura, ip_outra_ponta=None):
+        """
+        Passa a registrar os datagramas enviados e recebidos pelo enlace que
+        leva a ip_outra_ponta (ou por todos, se omitido) na captura dada, um
+        objeto da classe Captura (vide captura.py). Use None para parar.
+        """
+        if ip_outra_ponta is None:
+            for enlace in self.enlaces.values():
+                enlace.captura = captura
+        else:
+            self.enlaces[ip_outra_ponta].captura = captura
+
     def enviar(self, datagrama, next_hop):
         """
         Envia datagrama para next_hop, onde next_hop é um endereço IPv4
@@ -39,71 +72,193 @@ class CamadaEnlace:
             self.callback(datagrama)
 
 
+END = 0xC0
+ESC = 0xDB
+ESC_END = 0xDC
+ESC_ESC = 0xDD
+
+# Maior datagrama IPv4 possível
+TAMANHO_MAXIMO_QUADRO = 65535
+
+# MTU padrão de cada enlace. Para conversar com o slattach do Linux, que usa
+# 296 por padrão, configure o mesmo valor nas duas pontas.
+MTU = 1500
+
+# Quantidade de bytes codificados a partir da qual a fila de transmissão é
+# descarregada imediatamente, sem esperar o fim da iteração do laço de eventos
+LIMIAR_DESCARGA = 4096
+
+
 class Enlace:
-    def __init__(self, linha_serial):
+    def __init__(self, linha_serial, tamanho_maximo_quadro=TAMANHO_MAXIMO_QUADRO,
+                 limiar_descarga=LIMIAR_DESCARGA, cslip=False, slots_cslip=SLOTS,
+                 captura=None, mtu=MTU):
         self.linha_serial = linha_serial
         self.linha_serial.registrar_recebedor(self.__raw_recv)
-        self.buffer = b''
+        self.callback = None
+        if mtu < MTU_MINIMO:
+            raise ValueError('MTU %d menor que o mínimo de %d bytes' % (mtu, MTU_MINIMO))
+        self.mtu = mtu
+        # Estado do decodificador: o quadro em montagem fica em um buffer
+        # pré-alocado, do qual apenas os primeiros self.tamanho bytes valem.
+        self.tamanho_maximo_quadro = tamanho_maximo_quadro
+        self.buffer = bytearray(tamanho_maximo_quadro)
+        self.tamanho = 0
+        self.escapando = False      # último byte recebido foi um ESC
+        # Motivo pelo qual o quadro atual é inválido ('tamanho' ou 'escape'),
+        # ou None. Um quadro inválido é ignorado até o END.
+        self.descartando = None
+        self.quadros_descartados = 0
+        # Fila de transmissão: quadros já codificados aguardando uma única
+        # escrita na linha serial ao fim da iteração atual do laço de eventos
+        self.limiar_descarga = limiar_descarga
+        self.saida = bytearray()
+        self.descarga_agendada = False
+        # Compressão de cabeçalhos TCP/IP (RFC 1144), se ativada
+        self.compressor = Compressor(slots_cslip) if cslip else None
+        self.descompressor = Descompressor(slots_cslip) if cslip else None
+        # Captura de pacotes (vide captura.py), que vê os datagramas antes da
+        # compressão e depois da descompressão
+        self.captura = captura
 
     def registrar_recebedor(self, callback):
         self.callback = callback
 
     def enviar(self, datagrama):
-        segmento = datagrama
-        if b'\xDB' in datagrama:
-            segmento = segmento.replace(b'\xDB', b'\xDB\xDD')
+        """
+        Codifica o datagrama na fila de transmissão. Quadros enfileirados na
+        mesma iteração do laço de eventos são escritos juntos na linha serial,
+        compartilhando o END que separa um quadro do seguinte.
+        """
+        if self.captura is not None:
+            self.captura(datagrama)
+        if self.compressor:
+            datagrama = self.compressor.comprimir(datagrama)
+        if b'\xdb' in datagrama:
+            datagrama = datagrama.replace(b'\xdb', b'\xdb\xdd')
         if b'\xc0' in datagrama:
-            segmento = segmento.replace(b'\xc0', b'\xDB\xDC')
-        self.linha_serial.enviar(b'\xc0' + segmento + b'\xc0')
+            datagrama = datagrama.replace(b'\xc0', b'\xdb\xdc')
+        saida = self.saida
+        if not saida:
+            saida.append(END)
+        saida += datagrama
+        saida.append(END)
+        registro.contadores['slip.quadros_enviados'] += 1
+
+        if len(saida) >= self.limiar_descarga:
+            self.descarregar()
+        elif not self.descarga_agendada:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Sem laço de eventos rodando, não há a quem delegar a escrita
+                self.descarregar()
+                return
+            loop.call_soon(self.descarregar)
+            self.descarga_agendada = True
+
+    def descarregar(self):
+        """
+        Escreve na linha serial, de uma só vez, tudo o que estiver na fila
+        de transmissão.
+        """
+        self.descarga_agendada = False
+        if self.saida:
+            dados = bytes(self.saida)
+            del self.saida[:]
+            registro.contadores['slip.bytes_enviados'] += len(dados)
+            self.linha_serial.enviar(dados)
+
+    def _copiar(self, dados):
+        if self.descartando:
+            return
+        inicio = self.tamanho
+        fim = inicio + len(dados)
+        if fim > self.tamanho_maximo_quadro:
+            self.descartando = 'tamanho'
+            return
+        self.buffer[inicio:fim] = dados
+        self.tamanho = fim
 
-    def send_callback(self, mensagem):
-        mensagem = mensagem.replace(b'\xdb\xdd', b'\xdb')
-        mensagem = mensagem.replace(b'\xdb\xdc', b'\xc0')
+    def _fim_de_quadro(self):
+        tamanho = self.tamanho
+        descartando = self.descartando
+        self.tamanho = 0
+        self.escapando = False
+        self.descartando = None
+        if descartando:
+            self.quadros_descartados += 1
+            registro.contadores['slip.descartes.' + descartando] += 1
+            if self.descompressor:
+                self.descompressor.erro()
+            return
+        if tamanho == 0 or not self.callback:
+            # quadros vazios surgem entre dois END consecutivos
+            return
+        registro.contadores['slip.quadros_recebidos'] += 1
+        quadro = bytes(self.buffer[:tamanho])
+        if self.descompressor:
+            quadro = self.descompressor.descomprimir(quadro)
+            if quadro is None:
+                registro.contadores['slip.descartes.cslip'] += 1
+                return
+        if self.captura is not None:
+            self.captura(quadro)
         try:
-            self.callback(mensagem)
+            self.callback(quadro)
         except:
             import traceback
             traceback.print_exc()
-        finally:
-            self.buffer = b''
-            
-    def __raw_recv(self, dados):      
-        #verificando mensagem vazia
-        if dados == b'\xc0':
-            if self.buffer != b'':
-                self.send_callback(self.buffer)
-                self.buffer = b''
-        else:
-            #verficando mensagem completa
-            if dados.endswith(b'\xc0') and self.buffer == b'':
-                mensagens = dados.split(b'\xc0')
-                for msg in mensagens:
-                    if msg != b'':
-                        self.buffer = b''
-                        self.send_callback(msg)
 
+    def __raw_recv(self, dados):
+        """
+        Decodificador incremental: percorre cada pedaço recebido uma única
+        vez, saltando de um byte especial (END ou ESC) para o próximo e
+        copiando os trechos comuns inteiros para o buffer do quadro. Qualquer
+        divisão das sequências de escape entre leituras é tratada pelo estado
+        guardado em self.escapando.
+        """
+        n = len(dados)
+        registro.contadores['slip.bytes_recebidos'] += n
+        mv = memoryview(dados)
+        i = 0
+        if self.escapando and n:
+            if not self._desescapar(dados[0]):
+                i = 1
+        pos_end = dados.find(b'\xc0', i)
+        pos_esc = dados.find(b'\xdb', i)
+        while i < n:
+            if pos_esc != -1 and (pos_end == -1 or pos_esc < pos_end):
+                self._copiar(mv[i:pos_esc])
+                i = pos_esc + 1
+                if i == n:
+                    # o ESC ficou no fim do pedaço; o próximo byte chega depois
+                    self.escapando = True
+                    break
+                if not self._desescapar(dados[i]):
+                    i += 1
+                pos_esc = dados.find(b'\xdb', i)
+            elif pos_end != -1:
+                self._copiar(mv[i:pos_end])
+                self._fim_de_quadro()
+                i = pos_end + 1
+                pos_end = dados.find(b'\xc0', i)
             else:
-                if dados.startswith(b'\xc0'):
-                    if self.buffer != b'':
-                        self.send_callback(self.buffer)
-                        self.buffer = b''
-
-                    if dados.endswith(b'\xc0'):
-                        dados = dados.replace(b'\xdb\xdd', b'\xdb')
-                        dados = dados.replace(b'\xdb\xdc', b'\xc0')
-                        self.send_callback(dados.split(b'\xc0')[1])
-                    else:
-                        self.buffer = self.buffer.replace(b'\xdb\xdd', b'\xdb')
-                        self.buffer = self.buffer.replace(b'\xdb\xdc', b'\xc0')
-                        self.buffer += dados.split(b'\xc0')[1]
-                else:
-                    if dados.endswith(b'\xc0'):
-                        self.buffer += dados.split(b'\xc0')[0]
-                        
-                        mensagens = self.buffer.split(b'\xc0')
-                        for msg in mensagens:
-                            self.send_callback(msg)
-
-                        self.buffer = b''
-                    else:    
-                        self.buffer += dados                           
+                self._copiar(mv[i:])
+                break
+        mv.release()
+
+    def _desescapar(self, b):
+        """
+        Trata o byte que segue um ESC. Retorna True se o byte não foi
+        consumido (um END após ESC encerra o quadro, que é descartado).
+        """
+        self.escapando = False
+        if b == ESC_END:
+            self._copiar(b'\xc0')
+        elif b == ESC_ESC:
+            self._copiar(b'\xdb')
+        else:
+            self.descartando = 'escape'
+            return b == END
+        return False
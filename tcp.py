@@ -1,16 +1,212 @@
+import os
 import asyncio
-from collections import namedtuple
+import hashlib
+import weakref
+from collections import namedtuple, deque
 from tcputils import *
-import time
-Segment = namedtuple('Segment', ['msg','time','rtr'])
+from checksum import calc_checksum, fix_checksum
+from congestionamento import Reno
+from temporizador import RodaDeTemporizadores, relogio
+from metricas import registro, Histograma, DEPURACAO, INFORMACAO
+Segment = namedtuple('Segment', ['seq', 'tamanho', 'msg', 'time', 'rtr', 'sack'],
+                     defaults=(False,))
+
+# Números de sequência são tratados módulo 2**32
+MASCARA_SEQ = 0xffffffff
+
+# Opções TCP
+TCPOPT_EOL = 0
+TCPOPT_NOP = 1
+TCPOPT_SACK_PERMITTED = 4
+TCPOPT_SACK = 5
+OPCAO_SACK_PERMITTED = bytes([TCPOPT_NOP, TCPOPT_NOP, TCPOPT_SACK_PERMITTED, 2])
+
+# Quantidade de ACKs duplicados que dispara o fast retransmit
+LIMIAR_DUPACKS = 3
+
+# Capacidade padrão do buffer de recepção de cada conexão, que determina a
+# janela anunciada ao outro lado
+TAMANHO_BUFFER_RECEPCAO = 8*MSS
+
+# Tempo máximo (em segundos) que um ACK pode ser adiado à espera de um segundo
+# segmento ou de dados de resposta nos quais pegar carona
+ATRASO_ACK = 0.04
+
+# Marcas d'água padrão (em bytes ainda não enviados) para o controle de fluxo
+# entre a aplicação e o buffer de envio de cada conexão
+MARCA_ALTA_ENVIO = 64 * 1024
+MARCA_BAIXA_ENVIO = 16 * 1024
+
+# Limites do temporizador de retransmissão (em segundos)
+RTO_INICIAL = 1
+RTO_MINIMO = 0.2
+RTO_MAXIMO = 60
+
+# Estados de uma conexão (RFC 793). O servidor só faz abertura passiva, por
+# isso não há LISTEN; SYN_ENVIADO só ocorre nas conexões abertas por conectar.
+SYN_ENVIADO = 'SYN_ENVIADO'
+SYN_RECEBIDO = 'SYN_RECEBIDO'
+ESTABELECIDA = 'ESTABELECIDA'
+FIN_WAIT_1 = 'FIN_WAIT_1'
+FIN_WAIT_2 = 'FIN_WAIT_2'
+CLOSE_WAIT = 'CLOSE_WAIT'
+CLOSING = 'CLOSING'
+LAST_ACK = 'LAST_ACK'
+TIME_WAIT = 'TIME_WAIT'
+FECHADA = 'FECHADA'
+
+# Tempo que uma conexão passa em TIME_WAIT (2*MSL) e tempo máximo que espera
+# pelo FIN do outro lado em FIN_WAIT_2, em segundos
+TEMPO_TIME_WAIT = 60
+TEMPO_FIN_WAIT_2 = 60
+
+# Retransmissões do SYN (ou do SYN+ACK) antes de desistir de uma conexão
+TENTATIVAS_SYN = 5
+
+# Expirações seguidas do temporizador de retransmissão antes de abortar
+MAX_EXPIRACOES = 15
+
+# Número máximo padrão de conexões semiabertas (em SYN_RECEBIDO)
+BACKLOG = 128
+
+# Período (em segundos) do contador embutido nos SYN cookies. Um cookie vale
+# durante o período em que foi gerado e o seguinte.
+PERIODO_COOKIE = 64
+
+class Demultiplexador:
+    """
+    Camada entre a rede (IP) e os servidores TCP. Lê o cabeçalho de cada
+    segmento uma única vez, confere o checksum e o entrega ao servidor da
+    porta de destino, permitindo que vários servidores usem a mesma rede.
+    Segmentos para portas sem servidor são respondidos com RST.
+    """
+
+    def __init__(self, rede):
+        self.rede = rede
+        self.servidores = {}
+        # Uma única roda dirige os temporizadores de todas as conexões
+        self.roda = RodaDeTemporizadores()
+        self.rede.registrar_recebedor(self._rdt_rcv)
+
+    def registrar_servidor(self, porta, servidor):
+        if porta in self.servidores:
+            raise ValueError('a porta %d já está em uso' % porta)
+        self.servidores[porta] = servidor
+
+    def remover_servidor(self, porta):
+        self.servidores.pop(porta, None)
+
+    def enviar(self, segmento, dest_addr):
+        self.rede.enviar(segmento, dest_addr)
+
+    def _rdt_rcv(self, src_addr, dst_addr, segment):
+        src_port, dst_port, seq_no, ack_no, \
+            flags, window_size, checksum, urg_ptr = read_header(segment)
+
+        contadores = registro.contadores
+        contadores['tcp.segmentos_recebidos'] += 1
+        if registro.nivel <= DEPURACAO:
+            registro.rastrear(DEPURACAO, 'tcp', '%s:%d -> %s:%d seq=%d ack=%d flags=%#x (%d bytes)',
+                              src_addr, src_port, dst_addr, dst_port, seq_no, ack_no,
+                              flags & 0x3f, len(segment) - 4*(flags>>12))
+        if not self.rede.ignore_checksum and calc_checksum(segment, src_addr, dst_addr) != 0:
+            contadores['tcp.descartes.checksum'] += 1
+            return
+
+        tamanho_cabecalho = 4*(flags>>12)
+        contadores['tcp.bytes_recebidos'] += len(segment) - tamanho_cabecalho
+        id_conexao = (src_addr, src_port, dst_addr, dst_port)
+        servidor = self.servidores.get(dst_port)
+        if servidor is None:
+            contadores['tcp.descartes.porta_fechada'] += 1
+            if not flags & FLAGS_RST:
+                self._enviar_rst(id_conexao, seq_no, ack_no, flags, segment[tamanho_cabecalho:])
+            return
+        servidor._rdt_rcv(id_conexao, seq_no, ack_no, flags, window_size,
+                          segment[20:tamanho_cabecalho], segment[tamanho_cabecalho:])
+
+    def _enviar_rst(self, id_conexao, seq_no, ack_no, flags, payload):
+        """
+        Responde com RST a um segmento que não pertence a nenhuma conexão
+        (RFC 793, seção 3.4).
+        """
+        (dst_addr, dst_port, src_addr, src_port) = id_conexao
+        if flags & FLAGS_ACK:
+            header = montar_cabecalho(src_port, dst_port, ack_no, 0, FLAGS_RST, 0)
+        else:
+            comprimento = len(payload) + (1 if flags & FLAGS_SYN else 0) + (1 if flags & FLAGS_FIN else 0)
+            header = montar_cabecalho(src_port, dst_port, 0, (seq_no + comprimento) & MASCARA_SEQ,
+                                      FLAGS_RST | FLAGS_ACK, 0)
+        self.rede.enviar(fix_checksum(header, src_addr, dst_addr), dst_addr)
+
+
+# Demultiplexador de cada rede. As duas referências são fracas: quem mantém
+# o demultiplexador vivo é a própria rede, que o tem como recebedor, e assim
+# a entrada some junto com ela
+_demultiplexadores = weakref.WeakKeyDictionary()
+
+
+def obter_demultiplexador(rede):
+    """
+    Retorna o Demultiplexador associado à rede, criando-o na primeira vez.
+    """
+    ref = _demultiplexadores.get(rede)
+    demultiplexador = ref() if ref is not None else None
+    if demultiplexador is None:
+        demultiplexador = Demultiplexador(rede)
+        _demultiplexadores[rede] = weakref.ref(demultiplexador)
+    return demultiplexador
+
 
 class Servidor:
-    def __init__(self, rede, porta):
+    def __init__(self, rede, porta, controle_congestionamento=Reno, sack=False,
+                 tamanho_buffer_recepcao=TAMANHO_BUFFER_RECEPCAO, nagle=False,
+                 backlog=BACKLOG, syn_cookies=False, tempo_ocioso=None, aleatorio=None):
+        """
+        O argumento controle_congestionamento é a classe (vide
+        congestionamento.py) instanciada para cada conexão aceita. Se sack for
+        verdadeiro, o servidor aceita usar confirmações seletivas (RFC 2018)
+        com os clientes que as oferecerem no SYN. O tamanho_buffer_recepcao
+        limita quantos bytes recebidos e ainda não consumidos pela aplicação
+        cada conexão guarda. Se nagle for verdadeiro, as conexões aplicam o
+        algoritmo de Nagle, juntando escritas pequenas enquanto houver dados
+        em voo.
+
+        No máximo backlog conexões podem estar semiabertas (esperando o ACK
+        do handshake). Além desse limite, novos SYNs são descartados, ou, se
+        syn_cookies for verdadeiro, respondidos com um SYN cookie, sem guardar
+        estado. Se tempo_ocioso for dado, conexões que passarem esse número de
+        segundos sem receber nada são abortadas.
+
+        Os números de sequência iniciais das conexões abertas por conectar e
+        o segredo dos SYN cookies vêm de os.urandom, ou, se for fornecido, do
+        gerador aleatorio (um random.Random), o que torna simulações
+        reprodutíveis (vide simulador.py).
+
+        Vários servidores, em portas diferentes, podem usar a mesma rede: os
+        segmentos são distribuídos entre eles pelo Demultiplexador da rede.
+        """
         self.rede = rede
         self.porta = porta
+        self.controle_congestionamento = controle_congestionamento
+        self.sack = sack
+        self.tamanho_buffer_recepcao = tamanho_buffer_recepcao
+        self.nagle = nagle
+        self.backlog = backlog
+        self.syn_cookies = syn_cookies
+        self.tempo_ocioso = tempo_ocioso
+        self.meio_abertas = 0
+        self.aleatorio = aleatorio
+        self.segredo = self._bytes_aleatorios(16)
+        self.demultiplexador = obter_demultiplexador(rede)
+        self.roda = self.demultiplexador.roda
         self.conexoes = {}
         self.callback = None
-        self.rede.registrar_recebedor(self._rdt_rcv)
+        self.demultiplexador.registrar_servidor(porta, self)
+        # Vários hosts podem rodar no mesmo processo (vide simulador.py). Nem
+        # toda rede informa o próprio endereço.
+        self.nome_fonte = 'tcp.%s:%d' % (getattr(rede, 'meu_endereco', None), porta)
+        registro.registrar_fonte(self.nome_fonte, self.estatisticas)
 
     def registrar_monitor_de_conexoes_aceitas(self, callback):
         """
@@ -19,44 +215,138 @@ class Servidor:
         """
         self.callback = callback
 
-    def _rdt_rcv(self, src_addr, dst_addr, segment):
-        src_port, dst_port, seq_no, ack_no, \
-            flags, window_size, checksum, urg_ptr = read_header(segment)
-
-        print(src_addr)
-        print(dst_addr)
-        print(calc_checksum(segment, src_addr, dst_addr))
-        if dst_port != self.porta:
-            # Ignora segmentos que não são destinados à porta do nosso servidor
-            return
-        if not self.rede.ignore_checksum and calc_checksum(segment, src_addr, dst_addr) != 0:
-            print('descartando segmento com checksum incorreto')
-            return
-
-        payload = segment[4*(flags>>12):]
-        id_conexao = (src_addr, src_port, dst_addr, dst_port)
-        (dst_addr_res, dst_port_res, src_addr_res, src_port_res) = (src_addr, src_port, dst_addr, dst_port)
-        if flags & FLAGS_SYN == FLAGS_SYN:
-            conexao = self.conexoes[id_conexao] = Conexao(self, id_conexao, seq_no+1)
-            conexao.seq_no = seq_no + 1
-            conexao.ack_no = seq_no + 1
+    def _rdt_rcv(self, id_conexao, seq_no, ack_no, flags, window_size, opcoes, payload):
+        """
+        Recebe do Demultiplexador um segmento destinado à porta do servidor,
+        com o cabeçalho já interpretado.
+        """
+        conexao = self.conexoes.get(id_conexao)
+        if flags & (FLAGS_SYN | FLAGS_ACK | FLAGS_RST) == FLAGS_SYN:
             # A flag SYN estar setada significa que é um cliente tentando estabelecer uma conexão nova
-            # TODO: talvez você precise passar mais coisas para o construtor de conexão
-            header =  make_header(src_port_res, dst_port_res, seq_no, seq_no+1, FLAGS_SYN | FLAGS_ACK)
-            header = fix_checksum(header, src_addr_res, dst_addr_res)
-            self.rede.enviar(header, dst_addr_res)
-                    
-            # TODO: você precisa fazer o handshake aceitando a conexão. Escolha se você acha melhor
-            # fazer aqui mesmo ou dentro da classe Conexao.
-
+            if conexao is not None:
+                if conexao.estado == SYN_RECEBIDO and conexao.ack_no == (seq_no + 1) & MASCARA_SEQ:
+                    conexao._enviar_syn()      # SYN retransmitido
+                    return
+                if conexao.estado != TIME_WAIT or not seq_menor(conexao.ack_no, seq_no):
+                    # Conexão sincronizada: responde com um ACK (RFC 5961)
+                    conexao._enviar_segmento(FLAGS_ACK)
+                    return
+                # Nova encarnação de uma conexão em TIME_WAIT
+                conexao._mudar_estado(FECHADA)
+            if self.meio_abertas >= self.backlog:
+                if self.syn_cookies:
+                    registro.contadores['tcp.syn_cookies_enviados'] += 1
+                    self._enviar_cookie(id_conexao, seq_no)
+                else:
+                    registro.contadores['tcp.descartes.backlog_cheio'] += 1
+                return
+            conexao = self.conexoes[id_conexao] = Conexao(self, id_conexao, seq_no+1)
+            conexao.seq_no = conexao.seq_base = (seq_no + 1) & MASCARA_SEQ
+            conexao.ack_no = (seq_no + 1) & MASCARA_SEQ
+            conexao.janela_par = window_size
+            conexao.sack = self.sack and TCPOPT_SACK_PERMITTED in ler_opcoes(opcoes)
+            self.meio_abertas += 1
+            registro.contadores['tcp.conexoes_aceitas'] += 1
+            conexao._enviar_syn()
             if self.callback:
                 self.callback(conexao)
-        elif id_conexao in self.conexoes:
+        elif conexao is not None:
             # Passa para a conexão adequada se ela já estiver estabelecida
-            self.conexoes[id_conexao]._rdt_rcv(seq_no, ack_no, flags, payload)
+            conexao._rdt_rcv(seq_no, ack_no, flags, payload, window_size, opcoes)
+        elif self.syn_cookies and flags & (FLAGS_SYN | FLAGS_ACK | FLAGS_RST) == FLAGS_ACK and \
+                self._validar_cookie(id_conexao, (seq_no - 1) & MASCARA_SEQ, (ack_no - 1) & MASCARA_SEQ):
+            # ACK que completa um handshake feito com SYN cookie
+            conexao = self.conexoes[id_conexao] = Conexao(self, id_conexao, ack_no)
+            conexao.estado = ESTABELECIDA
+            conexao.ack_no = seq_no
+            registro.contadores['tcp.conexoes_aceitas'] += 1
+            registro.contadores['tcp.syn_cookies_aceitos'] += 1
+            conexao.janela_par = window_size
+            if self.callback:
+                self.callback(conexao)
+            conexao._rdt_rcv(seq_no, ack_no, flags, payload, window_size, opcoes)
         else:
-            print('%s:%d -> %s:%d (pacote associado a conexão desconhecida)' %
-                  (src_addr, src_port, dst_addr, dst_port))
+            registro.contadores['tcp.descartes.conexao_desconhecida'] += 1
+            if registro.nivel <= INFORMACAO:
+                registro.rastrear(INFORMACAO, 'tcp', '%s:%d -> %s:%d (pacote associado a conexão desconhecida)',
+                                  *id_conexao)
+            if not flags & FLAGS_RST:
+                self.demultiplexador._enviar_rst(id_conexao, seq_no, ack_no, flags, payload)
+
+    def _enviar_syn(self, id_conexao, seq_no, ack_no, flags, janela, opcoes=b''):
+        (dst_addr, dst_port, src_addr, src_port) = id_conexao
+        header = montar_cabecalho(src_port, dst_port, seq_no, ack_no, flags, janela, opcoes)
+        self.rede.enviar(fix_checksum(header, src_addr, dst_addr), dst_addr)
+
+    def _bytes_aleatorios(self, n):
+        if self.aleatorio is None:
+            return os.urandom(n)
+        return self.aleatorio.getrandbits(8*n).to_bytes(n, 'big')
+
+    def _cookie(self, id_conexao, seq_cliente, contador):
+        """
+        Número de sequência inicial que codifica a conexão: 5 bits do
+        contador de tempo seguidos de 27 bits de um hash com chave secreta.
+        Como o MSS é fixo, não é preciso codificá-lo.
+        """
+        h = hashlib.blake2b(repr((id_conexao, seq_cliente, contador)).encode(),
+                            key=self.segredo, digest_size=4)
+        return ((contador & 0x1f) << 27) | (int.from_bytes(h.digest(), 'big') & 0x7ffffff)
+
+    def _enviar_cookie(self, id_conexao, seq_no):
+        # Sem estado guardado, a conexão não poderá usar SACK
+        contador = int(relogio() // PERIODO_COOKIE)
+        self._enviar_syn(id_conexao, self._cookie(id_conexao, seq_no, contador),
+                         (seq_no + 1) & MASCARA_SEQ, FLAGS_SYN | FLAGS_ACK,
+                         min(self.tamanho_buffer_recepcao, 0xffff))
+
+    def _validar_cookie(self, id_conexao, seq_cliente, cookie):
+        contador = int(relogio() // PERIODO_COOKIE)
+        for c in (contador, contador - 1):
+            if cookie >> 27 == c & 0x1f and cookie == self._cookie(id_conexao, seq_cliente, c):
+                return True
+        return False
+
+    def conectar(self, dst_addr, dst_port, callback=None, src_addr=None):
+        """
+        Abre uma conexão da porta deste servidor até dst_addr:dst_port
+        (abertura ativa) e retorna a Conexao. Os dados enviados antes do fim
+        do handshake ficam no buffer de envio. Se fornecido, callback(conexao)
+        é chamado quando a conexão for estabelecida. O src_addr padrão é o
+        endereço da rede.
+        """
+        if src_addr is None:
+            src_addr = self.rede.meu_endereco
+        id_conexao = (dst_addr, dst_port, src_addr, self.porta)
+        isn = int.from_bytes(self._bytes_aleatorios(4), 'big')
+        conexao = self.conexoes[id_conexao] = Conexao(self, id_conexao, (isn + 1) & MASCARA_SEQ)
+        conexao.estado = SYN_ENVIADO
+        conexao.monitor_estabelecida = callback
+        conexao._enviar_syn()
+        return conexao
+
+    def fechar(self):
+        """
+        Desativa o servidor: aborta as conexões (com RST), libera a porta e
+        retira as estatísticas dele do registro de métricas.
+        """
+        for conexao in list(self.conexoes.values()):
+            if conexao.estado != FECHADA:
+                conexao.abortar()
+        self.demultiplexador.remover_servidor(self.porta)
+        registro.remover_fonte(self.nome_fonte)
+
+    def estatisticas(self):
+        """
+        Retorna um dicionário com as estatísticas de cada conexão, indexado
+        por 'endereço:porta' do cliente.
+        """
+        return {'%s:%d' % conexao.id_conexao[:2]: conexao.estatisticas()
+                for conexao in self.conexoes.values()}
+
+    def _remover(self, conexao):
+        if self.conexoes.get(conexao.id_conexao) is conexao:
+            del self.conexoes[conexao.id_conexao]
 
 
 class Conexao:
@@ -66,57 +356,681 @@ class Conexao:
         self.id_conexao = id_conexao
         self.callback = None
         self.closed = False
-        self.not_ack = []
+        self.estado = SYN_RECEBIDO
+        self.monitor_estabelecida = None
+        # closed indica que a aplicação fechou o sentido de envio; aviso_fim,
+        # que ela já recebeu o b'' de fim de recepção (ou abortou a conexão)
+        self.aviso_fim = False
+        self.fechamento_pendente = False
+        self.seq_fin = None
+        # Temporizador do estado atual (retransmissão do SYN+ACK, TIME_WAIT
+        # ou FIN_WAIT_2) e contagem de expirações seguidas do RTO
+        self.timer_estado = None
+        self.tentativas = 0
+        self.expiracoes = 0
+        # Instrumentação (vide metricas.py)
+        self.retransmissoes = 0
+        self.histograma_rtt = Histograma()
+        self.ultima_atividade = relogio()
+        self.timer_ocioso = None
+        if servidor.tempo_ocioso:
+            self.timer_ocioso = servidor.roda.agendar(servidor.tempo_ocioso, self._verificar_ociosidade)
+        self.seq_no = seq_start      # próximo número de sequência a ser enviado
+        self.seq_base = seq_start    # número de sequência mais antigo não confirmado
+        self.ack_no = None
+        # Segmentos enviados e ainda não confirmados, em ordem de sequência
+        self.not_ack = deque()
+        # Buffer de envio: escritas da aplicação que aguardam espaço na janela
+        # do outro lado. Os segmentos são recortados delas com memoryview, a
+        # partir de deslocamento_envio no primeiro bloco, sem copiar o resto.
+        self.pendentes = deque()
+        self.deslocamento_envio = 0
+        self.bytes_pendentes = 0
+        self.nagle = servidor.nagle
+        self.envio_segurado = False
+        self.marca_alta = MARCA_ALTA_ENVIO
+        self.marca_baixa = MARCA_BAIXA_ENVIO
+        self.envio_pausado = False
+        self.monitor_de_fluxo = None
+        self.monitor_de_estado = None
+        self.janela_par = MSS
         self.timer = None
+        # Temporizador de persistência: com a janela do outro lado zerada e
+        # nada em voo, sonda a janela periodicamente, sem contar expirações
+        # nem mexer no controle de congestionamento
+        self.timer_persistencia = None
+        self.intervalo_persistencia = None
         self.dev_rtt = None
         self.estimated_rtt = None
-        self.timeout_interval = 1
+        self.timeout_interval = RTO_INICIAL
+        self.cc = servidor.controle_congestionamento(MSS)
+        # Recuperação de perdas: None, 'rapida' (após ACKs duplicados) ou
+        # 'rto' (após expiração do temporizador). Dura até que seja confirmado
+        # tudo o que estava em voo quando a perda foi detectada.
+        self.sack = False
+        self.dupacks = 0
+        self.recuperacao = None
+        self.ponto_recuperacao = None
+        self.inflacao = 0
+        # Segmentos recebidos à frente de ack_no, como [seq, dados, fin],
+        # ordenados pela distância até ack_no
+        self.fora_de_ordem = []
+        self.bytes_fora_de_ordem = 0
+        # Buffer de recepção: dados já confirmados que a aplicação ainda não
+        # consumiu porque pausou a leitura. A janela anunciada é o espaço livre.
+        self.tamanho_buffer_recepcao = servidor.tamanho_buffer_recepcao
+        self.recepcao = bytearray()
+        self.fin_recebido = False
+        self.leitura_pausada = False
+        self.janela_anunciada = 0
+        # ACK atrasado: quantos segmentos chegaram desde o último ACK enviado
+        self.ack_pendente = 0
+        self.timer_ack = None
 
-    def _timer_callback(self):
-        (_, _, dst_addr, _) = self.id_conexao
-        self.servidor.rede.enviar(self.not_ack[0].msg, dst_addr)
-        self.not_ack[0] = self.not_ack[0]._replace(rtr=True)
-        self.timer = asyncio.get_event_loop().call_later(self.timeout_interval, self._timer_callback)
+    def _enviar_segmento(self, flags, dados=b'', seq_no=None, opcoes=b''):
+        """
+        Monta um segmento desta conexão, com as portas e os endereços na
+        direção servidor -> cliente, e o envia. Retorna o segmento montado.
+        """
+        (dst_addr, dst_port, src_addr, src_port) = self.id_conexao
+        if seq_no is None:
+            seq_no = self.seq_no
+        if flags & FLAGS_ACK:
+            # Todo segmento com ACK confirma o que estava pendente (carona)
+            self.ack_pendente = 0
+            if self.timer_ack:
+                self.timer_ack.cancelar()
+                self.timer_ack = None
+        self.janela_anunciada = self._janela_anunciada()
+        ack_no = self.ack_no if self.ack_no is not None else 0
+        msg = montar_cabecalho(src_port, dst_port, seq_no, ack_no, flags,
+                               self.janela_anunciada, opcoes) + dados
+        msg = fix_checksum(msg, src_addr, dst_addr)
+        contadores = registro.contadores
+        contadores['tcp.segmentos_enviados'] += 1
+        contadores['tcp.bytes_enviados'] += len(dados)
+        self.servidor.rede.enviar(msg, dst_addr)
+        return msg
 
-    def _rdt_rcv(self, seq_no, ack_no, flags, payload):
-        if self.closed:
-            return 
-        print('recebido payload: %r' % payload)
-        if (seq_no > self.ack_no - 1 and ((flags & FLAGS_ACK) == FLAGS_ACK)):
-            if (self.not_ack and not self.not_ack[0].rtr):
-                rtt = time.time() - self.not_ack[0].time
-                if (not self.dev_rtt or not self.estimated_rtt):
-                    self.estimated_rtt = rtt
-                    self.dev_rtt = rtt/2
-                else:
-                    self.estimated_rtt = (1-0.125)*self.estimated_rtt + 0.125*rtt
-                    self.dev_rtt = (1 - 0.25)*self.dev_rtt + 0.25*abs(rtt-self.estimated_rtt)
-                self.timeout_interval = self.estimated_rtt + 4*self.dev_rtt
-
-            if (self.not_ack):
-                self.not_ack.pop(0)
-                if (self.timer):
-                    self.timer.cancel()
-                if (self.not_ack):
-                    self.timer = asyncio.get_event_loop().call_later(self.timeout_interval, self._timer_callback)
-                else:
-                    self.timer.cancel()
-        if (seq_no != self.ack_no):
+    def _enviar_syn(self):
+        # O SYN ocupa o número de sequência anterior ao primeiro byte de dados
+        if self.estado == SYN_ENVIADO:
+            flags, ack_no = FLAGS_SYN, 0
+            opcoes = OPCAO_SACK_PERMITTED if self.servidor.sack else b''
+        else:
+            flags, ack_no = FLAGS_SYN | FLAGS_ACK, self.ack_no
+            opcoes = OPCAO_SACK_PERMITTED if self.sack else b''
+        self.servidor._enviar_syn(self.id_conexao, (self.seq_start - 1) & MASCARA_SEQ, ack_no,
+                                  flags, self._janela_anunciada(), opcoes)
+        intervalo = min(RTO_INICIAL * 2**self.tentativas, RTO_MAXIMO)
+        self._agendar_estado(intervalo, self._syn_expirado)
+
+    def _syn_expirado(self):
+        self.timer_estado = None
+        self.tentativas += 1
+        if self.tentativas > TENTATIVAS_SYN:
+            self._abortar(enviar_rst=False)
+        else:
+            self._enviar_syn()
+
+    def _sincronizar(self, seq_no, ack_no, flags, window_size, opcoes):
+        """
+        Trata a resposta ao SYN enviado por uma abertura ativa.
+        """
+        if not flags & FLAGS_ACK or ack_no != self.seq_base:
             return
-        if (flags & FLAGS_FIN == FLAGS_FIN):
+        if flags & FLAGS_RST:
+            self._abortar(enviar_rst=False)     # conexão recusada
+            return
+        if not flags & FLAGS_SYN:
+            return
+        self.ack_no = (seq_no + 1) & MASCARA_SEQ
+        self.janela_par = window_size
+        self.sack = self.servidor.sack and TCPOPT_SACK_PERMITTED in ler_opcoes(opcoes)
+        self._mudar_estado(ESTABELECIDA)
+        self._enviar_segmento(FLAGS_ACK)
+        if self.monitor_estabelecida:
+            self.monitor_estabelecida(self)
+        self._transmitir()
+
+    def _agendar_estado(self, atraso, callback, *args):
+        if self.timer_estado:
+            self.timer_estado.cancelar()
+        self.timer_estado = self.servidor.roda.agendar(atraso, callback, *args)
+
+    def _mudar_estado(self, estado):
+        """
+        Passa a conexão para o estado dado. Ao chegar em FECHADA, libera os
+        temporizadores e os buffers e retira a conexão da tabela do servidor.
+        """
+        if self.estado == SYN_RECEBIDO:
+            self.servidor.meio_abertas -= 1
+        self.estado = estado
+        if self.timer_estado:
+            self.timer_estado.cancelar()
+            self.timer_estado = None
+        if estado == TIME_WAIT:
+            self._agendar_estado(TEMPO_TIME_WAIT, self._mudar_estado, FECHADA)
+        elif estado == FIN_WAIT_2:
+            self._agendar_estado(TEMPO_FIN_WAIT_2, self._mudar_estado, FECHADA)
+        elif estado == FECHADA:
+            registro.contadores['tcp.conexoes_fechadas'] += 1
+            for timer in (self.timer, self.timer_ack, self.timer_ocioso, self.timer_persistencia):
+                if timer:
+                    timer.cancelar()
+            self.timer = self.timer_ack = self.timer_ocioso = self.timer_persistencia = None
+            self.pendentes.clear()
+            self.bytes_pendentes = 0
+            self.not_ack.clear()
+            self.fora_de_ordem = []
+            self.bytes_fora_de_ordem = 0
+            del self.recepcao[:]
+            self.servidor._remover(self)
+        if self.monitor_de_estado:
+            self.monitor_de_estado(self, estado)
+
+    def _abortar(self, enviar_rst=True):
+        """
+        Encerra a conexão imediatamente, avisando o outro lado com RST (se
+        enviar_rst) e a aplicação com b'', se ela ainda não tiver recebido.
+        """
+        registro.contadores['tcp.conexoes_abortadas'] += 1
+        if enviar_rst:
+            if self.estado == SYN_ENVIADO:
+                # Nada foi recebido do outro lado, então não há o que confirmar
+                self._enviar_segmento(FLAGS_RST)
+            else:
+                self._enviar_segmento(FLAGS_RST | FLAGS_ACK)
+        self._mudar_estado(FECHADA)
+        self._avisar_fim()
+
+    def _avisar_fim(self):
+        if self.callback and not self.aviso_fim:
+            self.aviso_fim = True
             self.callback(self, b'')
-        elif len(payload) == 0:
+
+    def _verificar_ociosidade(self):
+        self.timer_ocioso = None
+        restante = self.servidor.tempo_ocioso - (relogio() - self.ultima_atividade)
+        if restante <= 0:
+            self._abortar()
+        else:
+            self.timer_ocioso = self.servidor.roda.agendar(restante, self._verificar_ociosidade)
+
+    def _retransmitir(self, i):
+        self.retransmissoes += 1
+        registro.contadores['tcp.retransmissoes'] += 1
+        (dst_addr, _, _, _) = self.id_conexao
+        self.servidor.rede.enviar(self.not_ack[i].msg, dst_addr)
+        self.not_ack[i] = self.not_ack[i]._replace(rtr=True)
+
+    def _timer_callback(self):
+        self.timer = None
+        if not self.not_ack:
+            return
+        self.expiracoes += 1
+        registro.contadores['tcp.expiracoes_rto'] += 1
+        if self.expiracoes > MAX_EXPIRACOES:
+            self._abortar()     # o outro lado parece ter sumido
+            return
+        self._retransmitir(0)
+        self.cc.ao_expirar(self._em_voo(), relogio())
+        self.recuperacao = 'rto'
+        self.ponto_recuperacao = self.seq_no
+        self.inflacao = 0
+        self.dupacks = 0
+        # Backoff exponencial: cada expiração seguida dobra o RTO, até que
+        # uma nova medição de RTT o recalcule
+        self.timeout_interval = min(2*self.timeout_interval, RTO_MAXIMO)
+        self._armar_timer()
+
+    def _armar_timer(self):
+        # Há no máximo um temporizador de retransmissão vivo por conexão
+        if self.timer:
+            self.timer.cancelar()
+        self.timer = self.servidor.roda.agendar(self.timeout_interval, self._timer_callback)
+
+    def _parar_timer(self):
+        if self.timer:
+            self.timer.cancelar()
+            self.timer = None
+
+    def _armar_persistencia(self):
+        if self.timer_persistencia:
+            return
+        self.intervalo_persistencia = self.timeout_interval
+        self.timer_persistencia = self.servidor.roda.agendar(self.intervalo_persistencia,
+                                                             self._sondar_janela)
+
+    def _parar_persistencia(self):
+        if self.timer_persistencia:
+            self.timer_persistencia.cancelar()
+            self.timer_persistencia = None
+
+    def _sondar_janela(self):
+        """
+        Sonda a janela zerada com um segmento vazio de número de sequência
+        já confirmado, que o outro lado responde com um ACK trazendo a
+        janela atual (RFC 1122, 4.2.2.17). Continua sondando enquanto ela
+        estiver zerada, com backoff exponencial limitado a RTO_MAXIMO.
+        """
+        self.timer_persistencia = None
+        if self.janela_par or not self.bytes_pendentes or self._em_voo():
+            self._transmitir()
+            return
+        registro.contadores['tcp.sondas_janela'] += 1
+        self._enviar_segmento(FLAGS_ACK, seq_no=(self.seq_base - 1) & MASCARA_SEQ)
+        self.intervalo_persistencia = min(2*self.intervalo_persistencia, RTO_MAXIMO)
+        self.timer_persistencia = self.servidor.roda.agendar(self.intervalo_persistencia,
+                                                             self._sondar_janela)
+
+    def _em_voo(self):
+        return (self.seq_no - self.seq_base) & MASCARA_SEQ
+
+    def _atualizar_rtt(self, rtt):
+        if (not self.dev_rtt or not self.estimated_rtt):
+            self.estimated_rtt = rtt
+            self.dev_rtt = rtt/2
+        else:
+            self.estimated_rtt = (1-0.125)*self.estimated_rtt + 0.125*rtt
+            self.dev_rtt = (1 - 0.25)*self.dev_rtt + 0.25*abs(rtt-self.estimated_rtt)
+        self.timeout_interval = min(max(self.estimated_rtt + 4*self.dev_rtt, RTO_MINIMO), RTO_MAXIMO)
+
+    def _marcar_sack(self, opcoes):
+        blocos = ler_opcoes(opcoes).get(TCPOPT_SACK)
+        if not blocos:
+            return
+        base = self.seq_base
+        for i, segmento in enumerate(self.not_ack):
+            if segmento.sack:
+                continue
+            ini = (segmento.seq - base) & MASCARA_SEQ
+            fim = ini + segmento.tamanho
+            for esq, dir in blocos:
+                if (esq - base) & MASCARA_SEQ <= ini and fim <= (dir - base) & MASCARA_SEQ:
+                    self.not_ack[i] = segmento._replace(sack=True)
+                    break
+
+    def _retransmitir_perdidos(self):
+        """
+        Retransmite o que foi perdido. Sem SACK, só se sabe que o primeiro
+        segmento não confirmado se perdeu. Com SACK, retransmite apenas os
+        buracos anteriores ao último trecho confirmado seletivamente, até o
+        limite da janela de congestionamento.
+        """
+        if not self.sack:
+            self._retransmitir(0)
+            return
+        ultimo_sack = None
+        for i, segmento in enumerate(self.not_ack):
+            if segmento.sack:
+                ultimo_sack = i
+        if ultimo_sack is None:
+            self._retransmitir(0)
+            return
+        orcamento = self.cc.cwnd
+        for i in range(ultimo_sack):
+            segmento = self.not_ack[i]
+            if segmento.sack or (segmento.rtr and i > 0):
+                continue
+            if orcamento < segmento.tamanho and i > 0:
+                break
+            self._retransmitir(i)
+            orcamento -= segmento.tamanho
+
+    def _ack_duplicado(self):
+        self.dupacks += 1
+        if self.recuperacao == 'rapida':
+            # Cada ACK duplicado indica que um segmento deixou a rede
+            self.inflacao += MSS
+            return
+        if self.dupacks == LIMIAR_DUPACKS and self.recuperacao is None:
+            registro.contadores['tcp.retransmissoes_rapidas'] += 1
+            self.cc.ao_detectar_perda(self._em_voo(), relogio())
+            self.recuperacao = 'rapida'
+            self.ponto_recuperacao = self.seq_no
+            self.inflacao = LIMIAR_DUPACKS * MSS
+            self._retransmitir_perdidos()
+            self._armar_timer()
+
+    def _processar_ack(self, ack_no, duplicado_possivel=False, opcoes=b''):
+        """
+        Trata ack_no de forma cumulativa: confirma todos os segmentos que
+        terminam até ele e libera espaço na janela para novos envios. Um ACK
+        que não confirma nada novo conta como duplicado se
+        duplicado_possivel (segmento sem dados e sem mudança de janela).
+        """
+        if self.sack and opcoes:
+            self._marcar_sack(opcoes)
+        confirmados = (ack_no - self.seq_base) & MASCARA_SEQ
+        if confirmados == 0:
+            if duplicado_possivel and self.not_ack:
+                self._ack_duplicado()
+            return
+        if confirmados > self._em_voo():
+            return
+        base = self.seq_base
+        self.seq_base = ack_no
+        self.dupacks = 0
+        self.expiracoes = 0
+        agora = relogio()
+        amostra = None
+        while self.not_ack:
+            segmento = self.not_ack[0]
+            if (segmento.seq + segmento.tamanho - base) & MASCARA_SEQ > confirmados:
+                break
+            self.not_ack.popleft()
+            # Algoritmo de Karn: não mede RTT de segmentos retransmitidos
+            if amostra is None and not segmento.rtr:
+                amostra = agora - segmento.time
+        if amostra is not None:
+            self._atualizar_rtt(amostra)
+            self.histograma_rtt.observar(amostra)
+            registro.histograma('tcp.rtt').observar(amostra)
+
+        if self.recuperacao:
+            if not seq_menor(ack_no, self.ponto_recuperacao):
+                self.recuperacao = None
+                self.inflacao = 0
+            elif self.not_ack:
+                # ACK parcial (NewReno): o próximo buraco também se perdeu
+                self._retransmitir_perdidos()
+                self.inflacao = max(0, self.inflacao - confirmados) + MSS
+        if self.recuperacao != 'rapida':
+            self.cc.ao_confirmar(confirmados, agora, amostra)
+        if self.not_ack:
+            self._armar_timer()
+        else:
+            self._parar_timer()
+
+    def _transmitir(self):
+        """
+        Envia os dados pendentes que couberem ao mesmo tempo na janela
+        anunciada pelo outro lado e na janela de congestionamento. Se nada
+        estiver em voo, envia ao menos um segmento, mesmo maior que a janela;
+        se a janela estiver zerada, arma o temporizador de persistência.
+
+        Segmentos menores que o MSS ficam retidos enquanto o envio estiver
+        segurado, ou, com o algoritmo de Nagle, enquanto houver dados em voo.
+        """
+        if self.estado in (SYN_ENVIADO, SYN_RECEBIDO):
+            return      # os dados esperam o fim do handshake (RFC 793, seção 3.9)
+        if self.janela_par and self.timer_persistencia:
+            self._parar_persistencia()
+        while self.bytes_pendentes:
+            tamanho = min(MSS, self.bytes_pendentes)
+            em_voo = self._em_voo()
+            if not self.janela_par and not em_voo:
+                self._armar_persistencia()
+                break
+            if tamanho < MSS and (self.envio_segurado or (self.nagle and em_voo)):
+                break
+            janela = min(self.janela_par, self.cc.cwnd + self.inflacao)
+            if em_voo and em_voo + tamanho > janela:
+                break
+            msg = self._enviar_segmento(FLAGS_ACK, self._retirar(tamanho))
+            self.not_ack.append(Segment(self.seq_no, tamanho, msg, relogio(), False))
+            self.seq_no = (self.seq_no + tamanho) & MASCARA_SEQ
+            if not self.timer:
+                self._armar_timer()
+        if self.fechamento_pendente and not self.bytes_pendentes and self.seq_fin is None:
+            self._enviar_fin()
+        if self.envio_pausado and self.bytes_pendentes <= self.marca_baixa:
+            self.envio_pausado = False
+            if self.monitor_de_fluxo:
+                self.monitor_de_fluxo(False)
+
+    def _enviar_fin(self):
+        # O FIN ocupa um número de sequência e é retransmitido como os dados
+        msg = self._enviar_segmento(FLAGS_FIN | FLAGS_ACK)
+        self.seq_fin = self.seq_no
+        self.not_ack.append(Segment(self.seq_no, 1, msg, relogio(), False))
+        self.seq_no = (self.seq_no + 1) & MASCARA_SEQ
+        if not self.timer:
+            self._armar_timer()
+
+    def _retirar(self, n):
+        """
+        Retira n bytes do início do buffer de envio. Se couberem num único
+        bloco, retorna uma memoryview dele, sem cópia.
+        """
+        partes = []
+        while n:
+            bloco = self.pendentes[0]
+            inicio = self.deslocamento_envio
+            disponivel = len(bloco) - inicio
+            if disponivel <= n:
+                partes.append(memoryview(bloco)[inicio:])
+                self.pendentes.popleft()
+                self.deslocamento_envio = 0
+                n -= disponivel
+                self.bytes_pendentes -= disponivel
+            else:
+                partes.append(memoryview(bloco)[inicio:inicio+n])
+                self.deslocamento_envio += n
+                self.bytes_pendentes -= n
+                n = 0
+        return partes[0] if len(partes) == 1 else b''.join(partes)
+
+    def _rdt_rcv(self, seq_no, ack_no, flags, payload, window_size=None, opcoes=b''):
+        if self.estado == FECHADA:
+            return
+        if registro.nivel <= DEPURACAO:
+            registro.rastrear(DEPURACAO, 'tcp', 'recebido payload: %r', payload)
+        if self.estado == SYN_ENVIADO:
+            self._sincronizar(seq_no, ack_no, flags, window_size, opcoes)
+            return
+        self.ultima_atividade = relogio()
+        if flags & FLAGS_RST:
+            # Só aceita RST dentro da janela, para dificultar ataques às cegas
+            if ((seq_no - self.ack_no) & MASCARA_SEQ) <= self.janela_anunciada:
+                self._abortar(enviar_rst=False)
+            return
+        if self.estado == TIME_WAIT:
+            if flags & FLAGS_FIN:
+                # O nosso ACK do FIN se perdeu: confirma de novo
+                self._enviar_segmento(FLAGS_ACK)
+                self._agendar_estado(TEMPO_TIME_WAIT, self._mudar_estado, FECHADA)
+            return
+        if (flags & FLAGS_ACK) == FLAGS_ACK:
+            if self.estado == SYN_RECEBIDO:
+                if seq_menor(ack_no, self.seq_base) or seq_menor(self.seq_no, ack_no):
+                    return
+                # Se a aplicação fechou durante o handshake, o FIN sai agora,
+                # depois dos dados pendentes
+                self._mudar_estado(FIN_WAIT_1 if self.fechamento_pendente else ESTABELECIDA)
+            duplicado_possivel = not payload and not (flags & FLAGS_FIN) and \
+                window_size in (None, self.janela_par)
+            if window_size is not None:
+                self.janela_par = window_size
+            self._processar_ack(ack_no, duplicado_possivel, opcoes)
+            self._transmitir()
+            if self.seq_fin is not None and self.seq_base == (self.seq_fin + 1) & MASCARA_SEQ:
+                # O nosso FIN foi confirmado
+                if self.estado == FIN_WAIT_1:
+                    self._mudar_estado(FIN_WAIT_2)
+                elif self.estado == CLOSING:
+                    self._mudar_estado(TIME_WAIT)
+                elif self.estado == LAST_ACK:
+                    self._mudar_estado(FECHADA)
+                    return
+        elif self.estado == SYN_RECEBIDO:
+            return
+        fin = (flags & FLAGS_FIN) == FLAGS_FIN
+        if not fin and len(payload) == 0:
+            if seq_menor(seq_no, self.ack_no):
+                # Fora da janela (como uma sonda de janela zerada): responde
+                # com um ACK, que informa a janela atual
+                self._enviar_segmento(FLAGS_ACK)
+            return
+        self._receber(seq_no, payload, fin)
+
+    def _receber(self, seq_no, payload, fin):
+        """
+        Entrega à aplicação os dados que chegaram em ordem, junto com os que
+        estavam guardados e se tornaram contíguos, numa única chamada. Dados
+        à frente de ack_no são guardados, dentro da janela anunciada.
+        """
+        deslocamento = (seq_no - self.ack_no) & MASCARA_SEQ
+        if deslocamento >= 0x80000000:
+            # Começa antes de ack_no: descarta o que já foi recebido
+            repetidos = (self.ack_no - seq_no) & MASCARA_SEQ
+            registro.contadores['tcp.segmentos_duplicados'] += 1
+            if repetidos >= len(payload) + (1 if fin else 0):
+                # Retransmissão de algo já confirmado; o ACK pode ter se perdido
+                self._enviar_segmento(FLAGS_ACK)
+                return
+            payload = payload[repetidos:]
+            deslocamento = 0
+        if deslocamento > 0:
+            registro.contadores['tcp.segmentos_fora_de_ordem'] += 1
+            self._guardar_fora_de_ordem(seq_no, deslocamento, payload, fin)
+            # ACK imediato (duplicado), para acionar o fast retransmit do outro lado
+            self._enviar_segmento(FLAGS_ACK, opcoes=self._opcoes_sack(seq_no))
+            return
+        janela = self._janela_anunciada()
+        if len(payload) > janela:
+            # Descarta o que não cabe no buffer; o outro lado retransmitirá
+            registro.contadores['tcp.descartes.janela_cheia'] += 1
+            payload = payload[:janela]
+            fin = False
+            if not payload:
+                self._enviar_segmento(FLAGS_ACK)
+                return
+
+        partes = [payload] if payload else []
+        self.ack_no = (self.ack_no + len(payload)) & MASCARA_SEQ
+        # Preencher um buraco, assim como receber FIN, exige ACK imediato
+        imediato = bool(self.fora_de_ordem)
+        while not fin and self.fora_de_ordem:
+            seq, dados, fin_guardado = self.fora_de_ordem[0]
+            deslocamento = (seq - self.ack_no) & MASCARA_SEQ
+            if 0 < deslocamento < 0x80000000:
+                break       # ainda há um buraco
+            self.fora_de_ordem.pop(0)
+            self.bytes_fora_de_ordem -= len(dados)
+            repetidos = (self.ack_no - seq) & MASCARA_SEQ if deslocamento else 0
+            if repetidos < len(dados):
+                partes.append(dados[repetidos:])
+                self.ack_no = (self.ack_no + len(dados) - repetidos) & MASCARA_SEQ
+            fin = fin_guardado
+        if fin:
+            self.ack_no = (self.ack_no + 1) & MASCARA_SEQ
+            self.fora_de_ordem = []
+            self.bytes_fora_de_ordem = 0
+            self.fin_recebido = True
+            imediato = True
+            self._fin_recebido()
+        self.ack_pendente += 1
+        if imediato:
+            self._enviar_segmento(FLAGS_ACK, opcoes=self._opcoes_sack())
+        if partes:
+            self.recepcao += partes[0] if len(partes) == 1 else b''.join(partes)
+        # A aplicação pode responder durante a entrega, levando o ACK de carona
+        self._entregar()
+        if self.ack_pendente >= 2:
+            self._enviar_segmento(FLAGS_ACK, opcoes=self._opcoes_sack())
+        elif self.ack_pendente and not self.timer_ack:
+            self.timer_ack = self.servidor.roda.agendar(ATRASO_ACK, self._ack_atrasado)
+
+    def _fin_recebido(self):
+        if self.estado == ESTABELECIDA:
+            self._mudar_estado(CLOSE_WAIT)
+        elif self.estado == FIN_WAIT_1:
+            # Fechamento simultâneo: o nosso FIN ainda não foi confirmado
+            self._mudar_estado(CLOSING)
+        elif self.estado == FIN_WAIT_2:
+            self._mudar_estado(TIME_WAIT)
+
+    def _ack_atrasado(self):
+        self.timer_ack = None
+        if self.ack_pendente:
+            self._enviar_segmento(FLAGS_ACK, opcoes=self._opcoes_sack())
+
+    def _janela_anunciada(self):
+        livre = self.tamanho_buffer_recepcao - len(self.recepcao)
+        return max(0, min(livre, 0xffff))
+
+    def _entregar(self):
+        """
+        Passa à aplicação o conteúdo do buffer de recepção, a menos que a
+        leitura esteja pausada, e depois o aviso de fim de conexão (b'').
+        """
+        if self.leitura_pausada:
             return
-            
-        self.ack_no += max(1, len(payload))
-        (src_addr, src_port, dst_addr, dst_port) = self.id_conexao
-        header = make_header(dst_port, src_port, self.seq_no, self.ack_no, FLAGS_ACK)
-        header = fix_checksum(header, src_addr, dst_addr)
-        self.servidor.rede.enviar(header, dst_addr)
-        self.callback(self, payload)
+        if self.recepcao:
+            dados = bytes(self.recepcao)
+            del self.recepcao[:]
+            self.callback(self, dados)
+        if self.fin_recebido and not self.recepcao and not self.leitura_pausada:
+            self.fin_recebido = False
+            self._avisar_fim()
+
+    def _guardar_fora_de_ordem(self, seq_no, deslocamento, payload, fin):
+        janela = self._janela_anunciada()
+        if deslocamento + len(payload) > janela or \
+                self.bytes_fora_de_ordem + len(payload) > janela:
+            return
+        i = 0
+        for i, (seq, dados, _) in enumerate(self.fora_de_ordem):
+            d = (seq - self.ack_no) & MASCARA_SEQ
+            if d == deslocamento:
+                if len(dados) >= len(payload):
+                    return      # já guardado
+                self.bytes_fora_de_ordem -= len(dados)
+                self.fora_de_ordem[i] = [seq_no, payload, fin]
+                self.bytes_fora_de_ordem += len(payload)
+                return
+            if d > deslocamento:
+                break
+        else:
+            i = len(self.fora_de_ordem)
+        self.fora_de_ordem.insert(i, [seq_no, payload, fin])
+        self.bytes_fora_de_ordem += len(payload)
+
+    def _opcoes_sack(self, recente=None):
+        """
+        Monta a opção SACK descrevendo os trechos guardados fora de ordem,
+        com o trecho que contém recente em primeiro lugar (RFC 2018).
+        """
+        if not self.sack or not self.fora_de_ordem:
+            return b''
+        blocos = []
+        for seq, dados, _ in self.fora_de_ordem:
+            fim = (seq + len(dados)) & MASCARA_SEQ
+            if blocos and not seq_menor(blocos[-1][1], seq):
+                if seq_menor(blocos[-1][1], fim):
+                    blocos[-1][1] = fim
+            else:
+                blocos.append([seq, fim])
+        if recente is not None:
+            for i, (esq, dir) in enumerate(blocos):
+                if not seq_menor(recente, esq) and seq_menor(recente, dir):
+                    blocos.insert(0, blocos.pop(i))
+                    break
+        blocos = blocos[:3]
+        return bytes([TCPOPT_NOP, TCPOPT_NOP, TCPOPT_SACK, 2 + 8*len(blocos)]) + \
+            b''.join(struct.pack('!II', esq, dir) for esq, dir in blocos)
 
     # Os métodos abaixo fazem parte da API
 
+    def estatisticas(self):
+        """
+        Retorna um dicionário com o estado e as estatísticas da conexão
+        """
+        return {
+            'estado': self.estado,
+            'cwnd': self.cc.cwnd,
+            'ssthresh': self.cc.ssthresh,
+            'em_voo': self._em_voo(),
+            'bytes_pendentes': self.bytes_pendentes,
+            'janela_par': self.janela_par,
+            'srtt': self.estimated_rtt,
+            'rto': self.timeout_interval,
+            'retransmissoes': self.retransmissoes,
+            'rtt': self.histograma_rtt.instantaneo(),
+        }
+
     def registrar_recebedor(self, callback):
         """
         Usado pela camada de aplicação para registrar uma função para ser chamada
@@ -124,28 +1038,156 @@ class Conexao:
         """
         self.callback = callback
 
+    def pausar_leitura(self):
+        """
+        Usado pela camada de aplicação para parar de receber dados. Os dados
+        que chegarem ficam no buffer de recepção, e a janela anunciada encolhe
+        até zerar, fazendo o outro lado esperar.
+        """
+        self.leitura_pausada = True
+
+    def retomar_leitura(self):
+        """
+        Usado pela camada de aplicação para voltar a receber dados, entregando
+        o que estiver no buffer de recepção.
+        """
+        self.leitura_pausada = False
+        self._entregar()
+        # Avisa o outro lado se a janela cresceu de forma significativa
+        # (evitando a síndrome da janela boba)
+        if self._janela_anunciada() - self.janela_anunciada >= \
+                min(MSS, self.tamanho_buffer_recepcao // 2):
+            self._enviar_segmento(FLAGS_ACK)
+
     def enviar(self, dados):
         """
         Usado pela camada de aplicação para enviar dados
         """
-        if len(dados) <= MSS:
-            (src_addr, src_port, dst_addr, dst_port) = self.id_conexao
-            msg =  make_header(src_port, dst_port, self.seq_no, self.ack_no, FLAGS_ACK) + dados
-            msg = fix_checksum(msg, src_addr,dst_addr)
-            self.servidor.rede.enviar(msg, dst_addr)
-            self.seq_no += len(dados)
-            self.not_ack.append(Segment(msg,time.time(),False))
-            self.timer = asyncio.get_event_loop().call_later(self.timeout_interval, self._timer_callback)
-        else:
-            self.enviar(dados[:MSS])
-            self.enviar(dados[MSS:])
+        if not dados or self.closed or self.estado == FECHADA:
+            return
+        if not isinstance(dados, bytes):
+            dados = bytes(dados)    # a aplicação poderia alterá-los depois
+        self.pendentes.append(dados)
+        self.bytes_pendentes += len(dados)
+        self._transmitir()
+        if not self.envio_pausado and self.bytes_pendentes > self.marca_alta:
+            self.envio_pausado = True
+            if self.monitor_de_fluxo:
+                self.monitor_de_fluxo(True)
+
+    def registrar_monitor_de_fluxo(self, callback):
+        """
+        Registra uma função para ser chamada com True quando os dados ainda
+        não enviados ultrapassarem a marca alta (a aplicação deve parar de
+        escrever) e com False quando voltarem à marca baixa.
+        """
+        self.monitor_de_fluxo = callback
+
+    def registrar_monitor_de_estado(self, callback):
+        """
+        Registra uma função para ser chamada com (conexao, estado) a cada
+        mudança de estado da conexão.
+        """
+        self.monitor_de_estado = callback
+
+    def definir_marcas_envio(self, marca_alta, marca_baixa):
+        self.marca_alta = marca_alta
+        self.marca_baixa = marca_baixa
+
+    def segurar_envio(self):
+        """
+        Usado pela camada de aplicação para reter segmentos incompletos, de
+        modo que várias escritas pequenas sejam enviadas juntas (como a
+        opção TCP_CORK do Linux).
+        """
+        self.envio_segurado = True
+
+    def liberar_envio(self):
+        """
+        Desfaz segurar_envio, enviando imediatamente o que estiver retido.
+        """
+        self.envio_segurado = False
+        self._transmitir()
+
+    def abortar(self):
+        """
+        Usado pela camada de aplicação para encerrar a conexão imediatamente,
+        descartando os dados pendentes e avisando o outro lado com RST
+        """
+        if self.estado != FECHADA:
+            self.closed = True
+            self.aviso_fim = True   # quem abortou foi a própria aplicação
+            self._abortar()
 
     def fechar(self):
         """
-        Usado pela camada de aplicação para fechar a conexão
+        Usado pela camada de aplicação para fechar a conexão. O FIN é enviado
+        depois de todos os dados pendentes.
         """
-        (src_addr, src_port, dst_addr, dst_port) = self.id_conexao
-        header = make_header(src_port, dst_port, self.seq_no , self.ack_no, FLAGS_FIN) 
-        header = fix_checksum(header, src_addr, dst_addr)  
-        self.servidor.rede.enviar(header, dst_addr)     
-        self.closed = True
\ No newline at end of file
+        if self.closed:
+            return
+        self.closed = True
+        if self.estado == SYN_ENVIADO:
+            self._mudar_estado(FECHADA)
+            return
+        if self.estado == SYN_RECEBIDO:
+            # O FIN espera o fim do handshake, como os dados
+            self.fechamento_pendente = True
+            self.envio_segurado = False
+            return
+        if self.estado == ESTABELECIDA:
+            self._mudar_estado(FIN_WAIT_1)
+        elif self.estado == CLOSE_WAIT:
+            self._mudar_estado(LAST_ACK)
+        else:
+            return
+        self.fechamento_pendente = True
+        self.envio_segurado = False
+        self._transmitir()
+
+
+def seq_menor(a, b):
+    """
+    Compara dois números de sequência levando em conta a volta módulo 2**32
+    """
+    return ((a - b) & MASCARA_SEQ) >= 0x80000000
+
+
+def montar_cabecalho(src_port, dst_port, seq_no, ack_no, flags, janela=8*MSS, opcoes=b''):
+    """
+    Constrói um cabeçalho TCP como tcputils.make_header, mas permitindo
+    escolher a janela anunciada e incluir opções. As opções são completadas
+    com bytes nulos (fim de lista) até um múltiplo de 4 bytes.
+    """
+    if len(opcoes) % 4:
+        opcoes += bytes(4 - len(opcoes) % 4)
+    doff = 5 + len(opcoes) // 4
+    return struct.pack('!HHIIHHHH',
+                       src_port, dst_port, seq_no, ack_no, (doff << 12) | flags,
+                       janela, 0, 0) + opcoes
+
+
+def ler_opcoes(opcoes):
+    """
+    Interpreta as opções de um cabeçalho TCP, retornando um dicionário
+    {tipo: valor}. Para SACK, o valor é uma lista de blocos (esq, dir).
+    """
+    resultado = {}
+    i = 0
+    n = len(opcoes)
+    while i < n:
+        tipo = opcoes[i]
+        if tipo == TCPOPT_EOL:
+            break
+        if tipo == TCPOPT_NOP:
+            i += 1
+            continue
+        if i + 1 >= n or opcoes[i+1] < 2:
+            break       # opção malformada
+        tamanho = opcoes[i+1]
+        valor = opcoes[i+2:i+tamanho]
+        if tipo == TCPOPT_SACK:
+            valor = [struct.unpack_from('!II', valor, j) for j in range(0, len(valor) - 7, 8)]
+        resultado[tipo] = valor
+        i += tamanho
+    return resultado
@@ -0,0 +1,129 @@
+"""
+Roda de temporizadores (hashed timing wheel) compartilhada pelas conexões TCP.
+
+Em vez de cada conexão criar e cancelar handles do asyncio a todo ACK, os
+temporizadores são guardados em uma roda com um número fixo de posições, cada
+uma correspondendo a um intervalo de resolucao segundos. Um único tique
+periódico do laço de eventos avança a roda e dispara o que tiver vencido.
+Agendar e cancelar custam O(1).
+"""
+
+import time
+import asyncio
+import traceback
+
+
+def relogio():
+    """
+    Instante atual, em segundos, no relógio do laço de eventos (o mesmo que
+    dirige os temporizadores, e que pode ser virtual, vide simulador.py)
+    """
+    try:
+        return asyncio.get_running_loop().time()
+    except RuntimeError:
+        pass
+    try:
+        # Fora do laço, como ao montar a pilha antes de rodá-lo
+        return asyncio.get_event_loop().time()
+    except RuntimeError:
+        # Nenhum laço definido: o relógio padrão dos laços do asyncio
+        return time.monotonic()
+
+
+class Temporizador:
+    """
+    Handle retornado por RodaDeTemporizadores.agendar.
+    """
+    __slots__ = ('roda', 'posicao', 'voltas', 'callback', 'args')
+
+    def __init__(self, roda, posicao, voltas, callback, args):
+        self.roda = roda
+        self.posicao = posicao
+        self.voltas = voltas
+        self.callback = callback
+        self.args = args
+
+    def cancelar(self):
+        """
+        Cancela o temporizador. Não tem efeito se ele já tiver disparado.
+        """
+        if self.roda is not None:
+            self.roda._remover(self)
+
+
+class RodaDeTemporizadores:
+    def __init__(self, resolucao=0.01, tamanho=512):
+        self.resolucao = resolucao
+        self.posicoes = [set() for _ in range(tamanho)]
+        self.tique = 0          # número do último tique processado
+        self.inicio = None      # instante do laço correspondente ao tique 0
+        self.ativos = 0
+        self.handle = None
+
+    def _loop(self):
+        return asyncio.get_event_loop()
+
+    def _tique_atual(self):
+        # A folga evita que um tique agendado exatamente para o instante atual
+        # seja arredondado para baixo e reagendado para o mesmo instante
+        return int((self._loop().time() - self.inicio) / self.resolucao + 1e-6)
+
+    def agendar(self, atraso, callback, *args):
+        """
+        Agenda callback(*args) para daqui a atraso segundos (com a precisão
+        de um tique da roda) e retorna um Temporizador.
+        """
+        if self.inicio is None:
+            self.inicio = self._loop().time()
+        elif self.ativos == 0:
+            # Roda parada: pula os tiques em que não havia nada agendado
+            self.tique = max(self.tique, self._tique_atual())
+        tiques = max(1, -int(-atraso // self.resolucao))
+        # Conta a partir do tique em que estamos, e não do último processado,
+        # para não disparar cedo quando o laço estiver atrasado
+        alvo = max(self._tique_atual(), self.tique) + tiques
+        n = len(self.posicoes)
+        voltas = (alvo - self.tique - 1) // n
+        temporizador = Temporizador(self, alvo % n, voltas, callback, args)
+        self.posicoes[temporizador.posicao].add(temporizador)
+        self.ativos += 1
+        if self.handle is None:
+            self._agendar_tique()
+        return temporizador
+
+    def _remover(self, temporizador):
+        self.posicoes[temporizador.posicao].discard(temporizador)
+        temporizador.roda = None
+        self.ativos -= 1
+        if self.ativos == 0 and self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _agendar_tique(self):
+        proximo = self.inicio + (self.tique + 1) * self.resolucao
+        self.handle = self._loop().call_at(proximo, self._avancar)
+
+    def _avancar(self):
+        self.handle = None
+        atual = self._tique_atual()
+        n = len(self.posicoes)
+        # Processa também os tiques perdidos se o laço tiver se atrasado
+        while self.tique < atual and self.ativos:
+            self.tique += 1
+            posicao = self.posicoes[self.tique % n]
+            vencidos = []
+            for temporizador in posicao:
+                if temporizador.voltas:
+                    temporizador.voltas -= 1
+                else:
+                    vencidos.append(temporizador)
+            for temporizador in vencidos:
+                if temporizador.roda is None:
+                    continue    # cancelado por outro callback deste tique
+                self._remover(temporizador)
+                try:
+                    temporizador.callback(*temporizador.args)
+                except:
+                    traceback.print_exc()
+        if self.ativos and self.handle is None:
+            self._agendar_tique()
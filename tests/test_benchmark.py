@@ -0,0 +1,26 @@
+import asyncio
+from simulador import LacoVirtual
+from benchmark import medir_encaminhamento
+
+
+def executar(corrotina):
+    laco = LacoVirtual()
+    asyncio.set_event_loop(laco)
+    try:
+        return laco.run_until_complete(corrotina)
+    finally:
+        laco.close()
+        asyncio.set_event_loop(None)
+
+
+def test_encaminhamento_em_linha_lenta():
+    # A 115200 bauds, o primeiro bloco leva mais que SILENCIO para chegar
+    opcoes = {'baud': 115200, 'latencia': 0.001, 'semente': 1}
+    resultado = executar(medir_encaminhamento(opcoes, 300, 64))
+    assert resultado['recebidos'] == 300
+
+
+def test_encaminhamento_com_perdas_termina():
+    opcoes = {'baud': 115200, 'perda': 1e-3, 'semente': 1}
+    resultado = executar(medir_encaminhamento(opcoes, 300, 64))
+    assert 0 < resultado['recebidos'] < 300
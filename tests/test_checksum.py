@@ -0,0 +1,38 @@
+import random
+import pytest
+import checksum
+import tcputils
+
+ENDERECOS = ('192.168.200.4', '192.168.200.2')
+
+
+def amostras():
+    aleatorio = random.Random(1)
+    for tamanho in list(range(0, 41)) + [1499, 1500, 4096, 65535]:
+        yield bytes(aleatorio.randrange(256) for _ in range(tamanho))
+    # Somas nulas e múltiplas de 0xffff, em que o complemento de um se distingue
+    yield bytes(20)
+    yield b'\xff\xff' * 10
+    yield b'\xff\xff\x00'
+    yield b'\x12\x34\xed\xcb'
+
+
+@pytest.mark.parametrize('dados', list(amostras()), ids=len)
+def test_calc_checksum_igual_ao_de_tcputils(dados):
+    assert checksum.calc_checksum(dados) == tcputils.calc_checksum(dados)
+    assert checksum.calc_checksum(dados, *ENDERECOS) == tcputils.calc_checksum(dados, *ENDERECOS)
+    assert checksum.calc_checksum(bytearray(dados)) == tcputils.calc_checksum(dados)
+    assert checksum.calc_checksum(memoryview(dados)) == tcputils.calc_checksum(dados)
+
+
+@pytest.mark.parametrize('dados', [d for d in amostras() if len(d) >= 20], ids=len)
+def test_fix_checksum_igual_ao_de_tcputils(dados):
+    assert checksum.fix_checksum(dados, *ENDERECOS) == tcputils.fix_checksum(dados, *ENDERECOS)
+
+
+def test_caminho_numpy_igual_ao_de_tcputils(monkeypatch):
+    if checksum.numpy is None:
+        pytest.skip('NumPy não instalado')
+    monkeypatch.setattr(checksum, 'LIMIAR_NUMPY', 2)
+    for dados in amostras():
+        assert checksum.calc_checksum(dados) == tcputils.calc_checksum(dados)
@@ -0,0 +1,59 @@
+import asyncio
+import pytest
+from simulador import Simulacao, topologia_das_placas
+from fluxos import servir
+from tcp import FECHADA, TIME_WAIT
+
+
+class Remetente(asyncio.Protocol):
+    """Escreve os dados e fecha o transporte logo em seguida"""
+
+    def __init__(self, dados, eventos):
+        self.dados = dados
+        self.eventos = eventos
+
+    def connection_made(self, transporte):
+        self.transporte = transporte
+        transporte.write(self.dados)
+        transporte.close()
+        self.eventos.append('close')
+
+    def connection_lost(self, exc):
+        conexao = self.transporte.conexao
+        self.eventos.append(('lost', exc, conexao.estado, conexao.bytes_pendentes))
+
+
+@pytest.fixture
+def sim():
+    sim = Simulacao(topologia_das_placas(), baud=115200)
+    yield sim
+    sim.fechar()
+
+
+def test_close_envia_os_dados_antes_de_perder_a_conexao(sim):
+    dados = bytes(range(256)) * 200
+    eventos = []
+    servidor = servir(lambda: Remetente(dados, eventos), sim.redes['placa3'], 7000)
+    cliente = sim.servidor('placa1', 40000)
+    recebidos = []
+
+    def recebedor(conexao, pedaco):
+        recebidos.append(pedaco)
+        if not pedaco:
+            eventos.append('eof')
+            conexao.fechar()
+
+    conexao = cliente.conectar(sim.endereco('placa3'), 7000)
+    conexao.registrar_recebedor(recebedor)
+    sim.avancar(1)
+    # O fechamento ainda está em andamento: nada de connection_lost
+    assert eventos == ['close']
+    sim.avancar(30)
+    servidor.fechar()
+    assert b''.join(recebidos) == dados
+    assert eventos[:2] == ['close', 'eof']
+    assert len(eventos) == 3
+    _, exc, estado, pendentes = eventos[2]
+    assert exc is None
+    assert estado in (FECHADA, TIME_WAIT)
+    assert pendentes == 0
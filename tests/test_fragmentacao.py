@@ -0,0 +1,66 @@
+import random
+from fragmentacao import fragmentar, Remontador
+from ip import IP, make_ipv4_header
+from iputils import IPPROTO_TCP
+from metricas import registro
+
+
+def datagrama(tamanho, identification=1):
+    payload = bytes(random.Random(tamanho).randrange(256) for _ in range(tamanho))
+    return make_ipv4_header(payload, '192.168.200.4', '192.168.200.2', IPPROTO_TCP,
+                            identification=identification) + payload
+
+
+def test_remontagem_fora_de_ordem():
+    original = datagrama(3000)
+    fragmentos = fragmentar(original, 296)
+    assert len(fragmentos) > 2 and all(len(f) <= 296 for f in fragmentos)
+    random.Random(1).shuffle(fragmentos)
+    fragmentos = fragmentos[:2] + fragmentos    # duplicatas não atrapalham
+    remontador = Remontador()
+    remontados = [d for d in map(remontador.adicionar, fragmentos) if d is not None]
+    assert remontados == [original]
+    assert len(remontador) == 0 and remontador.memoria == 0
+
+
+def test_remontagem_de_fragmentos_refragmentados():
+    original = datagrama(2500)
+    fragmentos = [g for f in fragmentar(original, 1000) for g in fragmentar(f, 300)]
+    remontador = Remontador()
+    for fragmento in reversed(fragmentos):
+        resultado = remontador.adicionar(fragmento)
+    assert resultado == original
+
+
+def test_fragmento_truncado_descartado():
+    primeiro = fragmentar(datagrama(3000), 296)[0]
+    registro.zerar()
+    assert Remontador().adicionar(primeiro[:100]) is None
+    assert registro.contadores['ip.remontagem.invalidos'] == 1
+
+
+class EnlaceFalso:
+    ignore_checksum = False
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, datagrama, next_hop):
+        pass
+
+
+def test_ip_descarta_datagramas_malformados():
+    enlace = EnlaceFalso()
+    rede = IP(enlace)
+    rede.definir_endereco_host('192.168.200.2')
+    recebidos = []
+    rede.registrar_recebedor(lambda src, dst, segmento: recebidos.append(segmento))
+    valido = datagrama(50)
+    registro.zerar()
+    enlace.callback(valido[:10])        # menor que um cabeçalho
+    enlace.callback(valido[:40])        # truncado
+    enlace.callback(bytes([0x44]) + valido[1:])     # IHL menor que 20
+    assert registro.contadores['ip.descartes.malformados'] == 3
+    assert recebidos == []
+    enlace.callback(valido)
+    assert recebidos == [valido[20:]]
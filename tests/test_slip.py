@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+from simulador import LacoVirtual
+from camadafisica import par_de_linhas
+from slip import Enlace, END, ESC
+from ip import make_ipv4_header
+from iputils import IPPROTO_TCP
+from checksum import fix_checksum
+from tcp import montar_cabecalho, FLAGS_ACK
+from metricas import registro
+
+ORIGEM = '192.168.200.4'
+DESTINO = '192.168.200.2'
+
+# Bytes que o SLIP precisa escapar, e os que viram escapes depois de um ESC
+ESPECIAIS = bytes([END, ESC, 0xdc, 0xdd, END, END, ESC, ESC])
+
+
+def segmento(seq, payload):
+    cabecalho = montar_cabecalho(40000, 7000, seq, 1000, FLAGS_ACK)
+    segmento = fix_checksum(cabecalho + payload, ORIGEM, DESTINO)
+    return make_ipv4_header(segmento, ORIGEM, DESTINO, IPPROTO_TCP,
+                            identification=seq & 0xffff) + segmento
+
+
+def datagramas():
+    # Uma conversa TCP (cujos cabeçalhos o CSLIP comprime), intercalada com
+    # datagramas de outro protocolo, que passam sem compressão
+    resultado = []
+    seq = 1
+    for i in range(20):
+        payload = ESPECIAIS * (i + 1) + bytes([i])
+        resultado.append(segmento(seq, payload))
+        seq += len(payload)
+        if i % 5 == 0:
+            outro = ESPECIAIS + b'udp'
+            resultado.append(make_ipv4_header(outro, ORIGEM, DESTINO, 17) + outro)
+    return resultado
+
+
+@pytest.fixture
+def laco():
+    laco = LacoVirtual()
+    asyncio.set_event_loop(laco)
+    yield laco
+    laco.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.mark.parametrize('cslip', [False, True])
+@pytest.mark.parametrize('tamanho_pedaco', [None, 1, 3])
+def test_ida_e_volta(laco, cslip, tamanho_pedaco):
+    a, b = par_de_linhas(baud=115200, tamanho_pedaco=tamanho_pedaco)
+    emissor = Enlace(a, cslip=cslip)
+    receptor = Enlace(b, cslip=cslip)
+    recebidos = []
+    receptor.registrar_recebedor(recebidos.append)
+    enviados = datagramas()
+    registro.zerar()
+
+    async def enviar():
+        for datagrama in enviados:
+            emissor.enviar(datagrama)
+        await asyncio.sleep(5)
+
+    laco.run_until_complete(enviar())
+    assert [bytes(d) for d in recebidos] == enviados
+    assert receptor.quadros_descartados == 0
+    # Cada byte especial vira dois, e os quadros, escritos juntos, são
+    # separados por um único END. Com CSLIP, os cabeçalhos TCP/IP repetidos
+    # não atravessam a linha.
+    sem_compressao = 1 + sum(len(d) + d.count(END) + d.count(ESC) + 1 for d in enviados)
+    if cslip:
+        assert registro.contadores['slip.bytes_recebidos'] < sem_compressao
+    else:
+        assert registro.contadores['slip.bytes_recebidos'] == sem_compressao
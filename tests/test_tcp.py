@@ -0,0 +1,85 @@
+import gc
+import weakref
+import pytest
+import tcp
+from simulador import Simulacao, topologia_das_placas
+from tcp import FECHADA, SYN_RECEBIDO
+
+
+@pytest.fixture
+def sim():
+    # Linha lenta, para que o handshake ainda esteja em andamento
+    sim = Simulacao(topologia_das_placas(), baud=9600)
+    yield sim
+    sim.fechar()
+
+
+def test_abortar_antes_de_conectar(sim):
+    cliente = sim.servidor('placa1', 40000)
+    avisos = []
+    conexao = cliente.conectar(sim.endereco('placa3'), 7000)
+    conexao.registrar_recebedor(lambda c, dados: avisos.append(dados))
+    conexao.abortar()
+    assert conexao.estado == FECHADA
+    assert not cliente.conexoes
+    # quem abortou foi a própria aplicação, que não recebe aviso de fim
+    assert avisos == []
+
+
+def test_fechar_servidor_com_conexao_em_andamento(sim):
+    cliente = sim.servidor('placa1', 40000)
+    conexao = cliente.conectar(sim.endereco('placa3'), 7000)
+    cliente.fechar()
+    assert conexao.estado == FECHADA
+
+
+def test_ociosidade_antes_de_conectar(sim):
+    cliente = sim.servidor('placa1', 40000, tempo_ocioso=0.001)
+    conexao = cliente.conectar(sim.endereco('placa3'), 7000)
+    sim.avancar(0.01)
+    assert conexao.estado == FECHADA
+
+
+def test_dados_esperam_o_fim_do_handshake(sim):
+    servidor = sim.servidor('placa3', 7000)
+    aceitas = []
+
+    def aceita(conexao):
+        conexao.enviar(b'oi')
+        conexao.fechar()
+        # Nada sai antes do ACK que completa o handshake
+        aceitas.append((conexao.estado, conexao._em_voo(), conexao.seq_fin))
+
+    servidor.registrar_monitor_de_conexoes_aceitas(aceita)
+    cliente = sim.servidor('placa1', 40000)
+    recebidos = []
+    conexao = cliente.conectar(sim.endereco('placa3'), 7000)
+    conexao.registrar_recebedor(lambda c, dados: recebidos.append(dados))
+    sim.avancar(5)
+    assert aceitas == [(SYN_RECEBIDO, 0, None)]
+    assert recebidos == [b'oi', b'']
+
+
+class RedeFalsa:
+    meu_endereco = '10.0.0.1'
+
+    def registrar_recebedor(self, callback):
+        self.callback = callback
+
+    def enviar(self, segmento, dest_addr):
+        pass
+
+
+def test_servidores_compartilham_o_demultiplexador():
+    rede = RedeFalsa()
+    a = tcp.Servidor(rede, 7000)
+    b = tcp.Servidor(rede, 7001)
+    assert a.demultiplexador is b.demultiplexador is tcp.obter_demultiplexador(rede)
+    assert vars(rede).keys() == {'callback'}
+    a.fechar()
+    b.fechar()
+    # o registro não mantém a rede viva
+    ref = weakref.ref(rede)
+    del a, b, rede
+    gc.collect()
+    assert ref() is None